@@ -1,9 +1,96 @@
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import mmap
+import os
+import pickle
+import sys
+from array import array
+import weakref
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from heapq import heapify, heappop, heappush
+from itertools import accumulate, islice
+from time import perf_counter
+
 import pygame as pg
 import pygame.gfxdraw
 
+_fonts = {}
+
+
+def get_font(name, size, bold=False, italic=False):
+    key = (name, size, bool(bold), bool(italic))
+    font = _fonts.get(key)
+    if font is None:
+        font = _fonts[key] = pg.font.SysFont(name, size, bold, italic)
+    return font
+
+
+def preload_fonts(*specs):
+    for spec in specs:
+        get_font(*spec)
+
+
+def clear_font_cache():
+    _fonts.clear()
+    text_cache.clear()
+    for style in Style.styles.values():
+        style._font = None
+
+
+def _color_key(color):
+    if color is None or isinstance(color, tuple):
+        return color
+    return tuple(pg.Color(color))
+
+
+class TextCache:
+    # bounded by entries and by total pixels; a surface bigger than an
+    # eighth of the pixel budget is rendered but not kept
+    def __init__(self, maxsize=1024, max_pixels=1 << 23):
+        self.maxsize = maxsize
+        self.max_pixels = max_pixels
+        self.pixels = 0
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, color, background=None, antialias=True):
+        key = (font, text, _color_key(color), _color_key(background), antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = font.render(text, antialias, color, background)
+        width, height = surface.get_size()
+        if width * height > self.max_pixels // 8:
+            return surface
+        self.surfaces[key] = surface
+        self.pixels += width * height
+        while len(self.surfaces) > self.maxsize or self.pixels > self.max_pixels:
+            width, height = self.surfaces.popitem(last=False)[1].get_size()
+            self.pixels -= width * height
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+        self.pixels = 0
+        self.hits = 0
+        self.misses = 0
+
+
+text_cache = TextCache()
+
 
 def render_text_pos(screen, text, font, pos, color, background=None):
-    surface = font.render(text, True, color, background)
+    surface = text_cache.render(font, text, color, background)
     screen.blit(surface, pos)
 
 
@@ -15,54 +102,1469 @@ def render_text_rect(screen, text, font, rect, color, background=None):
                     color, background)
 
 
+class OverlayCache:
+    # filled SRCALPHA surfaces keyed by size and color; callers must not draw
+    # on the surfaces they get back
+    def __init__(self, max_pixels=1 << 22):
+        self.max_pixels = max_pixels
+        self.pixels = 0
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, size, color):
+        key = (tuple(size), _color_key(color))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = self.surfaces[key] = pg.Surface(size, pygame.SRCALPHA)
+        surface.fill(color)
+        self.pixels += size[0] * size[1]
+        while self.pixels > self.max_pixels and len(self.surfaces) > 1:
+            (width, height), _ = self.surfaces.popitem(last=False)[0]
+            self.pixels -= width * height
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+        self.pixels = 0
+        self.hits = 0
+        self.misses = 0
+
+
+overlay_cache = OverlayCache()
+
+
 def rect_transparent(screen, color, rect):
-    s = pg.Surface((rect.width, rect.height), pygame.SRCALPHA)
-    s.fill(color)
-    screen.blit(s, (rect.left, rect.top))
+    screen.blit(overlay_cache.get((rect.width, rect.height), color), (rect.left, rect.top))
+
+
+def is_text_event(event):
+    return event.type == pg.KEYDOWN and bool(event.unicode) and all(32 <= ord(c) <= 126 for c in event.unicode)
+
+
+def coalesce_events(events):
+    result = []
+    key_ups = []
+    for event in events:
+        last = result[-1] if result else None
+        if last is not None and last.type == event.type == pg.MOUSEMOTION:
+            rel = (last.rel[0] + event.rel[0], last.rel[1] + event.rel[1])
+            result[-1] = pg.event.Event(pg.MOUSEMOTION, dict(event.dict, rel=rel))
+            continue
+        if last is not None and last.type == pg.KEYDOWN:
+            if event.type == pg.KEYUP:
+                key_ups.append(event)
+                continue
+            # a change of modifiers starts a new event, e.g. LEFT then Shift+LEFT
+            if event.type == pg.KEYDOWN and getattr(event, 'mod', 0) == getattr(last, 'mod', 0):
+                count = getattr(last, 'count', 1) + 1
+                # the keystrokes a merged event stands for, for per-key hooks
+                sources = getattr(last, 'events', (last,)) + (event,)
+                if is_text_event(last) and is_text_event(event):
+                    result[-1] = pg.event.Event(pg.KEYDOWN, dict(last.dict, unicode=last.unicode + event.unicode,
+                                                                 count=count, events=sources))
+                    continue
+                if not is_text_event(event) and event.key == last.key and event.unicode == last.unicode:
+                    result[-1] = pg.event.Event(pg.KEYDOWN, dict(last.dict, count=count, events=sources))
+                    continue
+        result.extend(key_ups)
+        key_ups = []
+        result.append(event)
+    result.extend(key_ups)
+    return result
+
+
+class DirtyRects:
+    def __init__(self):
+        self.rects = []
+        self.deferred = False
+
+    def add(self, rect):
+        if rect.width > 0 and rect.height > 0:
+            self.rects.append(pg.Rect(rect))
+
+    def clear(self):
+        self.rects = []
+
+    def merged(self):
+        merged = []
+        for rect in self.rects:
+            rect = rect.copy()
+            i = rect.collidelist(merged)
+            while i != -1:
+                rect.union_ip(merged.pop(i))
+                i = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+    def update(self):
+        if not self.deferred:
+            self.flush()
+
+    def flush(self):
+        # compose is looked up on each flush so the profiler's wrapper is seen
+        for manager in list(WindowManager.managers.values()):
+            manager.compose()
+        if self.rects:
+            pg.display.update(self.merged())
+            self.clear()
+
+
+dirty_rects = DirtyRects()
+
+
+class Profiler:
+    methods = ('render', 'handle_event', 'draw_scrollbars', 'compose')
+
+    def __init__(self, history=120):
+        self.enabled = False
+        self.wrapped = []
+        self.running = set()
+        self.depth = {}
+        self.classes = {}
+        self.instances = weakref.WeakKeyDictionary()
+        self.frame = {}
+        self.frames = deque(maxlen=history)
+
+    def enable(self, methods=None):
+        methods = self.methods if methods is None else methods
+        classes = [Control, WindowManager]
+        while classes:
+            cls = classes.pop()
+            classes.extend(cls.__subclasses__())
+            for name in methods:
+                method = cls.__dict__.get(name)
+                if method is not None and not hasattr(method, 'profiled'):
+                    setattr(cls, name, self.wrap(method, name))
+                    self.wrapped.append((cls, name, method))
+        self.enabled = True
+
+    def disable(self):
+        for cls, name, method in reversed(self.wrapped):
+            setattr(cls, name, method)
+        self.wrapped = []
+        self.enabled = False
+
+    def wrap(self, method, name):
+        profiler = self
+
+        @functools.wraps(method)
+        def wrapper(control, *args, **kwargs):
+            key = (id(control), name)
+            if key in profiler.running:
+                return method(control, *args, **kwargs)
+            profiler.running.add(key)
+            depth = profiler.depth.get(name, 0)
+            profiler.depth[name] = depth + 1
+            start = perf_counter()
+            try:
+                return method(control, *args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                profiler.depth[name] = depth
+                profiler.running.discard(key)
+                profiler.record(control, name, elapsed, outermost=depth == 0)
+        wrapper.profiled = method
+        return wrapper
+
+    def record(self, control, name, elapsed, outermost=True):
+        for stats in (self.classes.setdefault((type(control).__name__, name), [0, 0.0, 0.0]),
+                      self.instances.setdefault(control, {}).setdefault(name, [0, 0.0, 0.0])):
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+        if outermost:
+            self.frame[name] = self.frame.get(name, 0.0) + elapsed
+
+    def end_frame(self):
+        if self.enabled:
+            self.frames.append(self.frame)
+        self.frame = {}
+
+    def reset(self):
+        self.classes.clear()
+        self.instances.clear()
+        self.frame = {}
+        self.frames.clear()
+
+    def class_stats(self):
+        return sorted(({'class': cls, 'method': name, 'count': count, 'total': total, 'max': max_time}
+                       for (cls, name), (count, total, max_time) in self.classes.items()),
+                      key=lambda stats: stats['total'], reverse=True)
+
+    def instance_stats(self, control):
+        return {name: {'count': count, 'total': total, 'max': max_time}
+                for name, (count, total, max_time) in self.instances.get(control, {}).items()}
+
+    def report(self, limit=10):
+        lines = ["%-12s %-14s %7s %9s %8s" % ("class", "method", "calls", "total ms", "max ms")]
+        for stats in self.class_stats()[:limit]:
+            lines.append("%-12s %-14s %7d %9.2f %8.2f" % (stats['class'][:12], stats['method'][:14], stats['count'],
+                                                         stats['total'] * 1000, stats['max'] * 1000))
+        if self.frames:
+            last = self.frames[-1]
+            lines.append("last frame: " + " ".join("%s %.2fms" % (name, t * 1000) for name, t in sorted(last.items())))
+        return lines
+
+
+profiler = Profiler()
+
+TASK_DONE = pg.event.custom_type()
+
+
+class Tasks:
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.callbacks = {}
+        self.done = deque()
+
+    def set_executor(self, executor):
+        # e.g. a ProcessPoolExecutor for CPU bound work; its tasks and results
+        # must then be picklable
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = executor
+
+    def submit(self, fn, *args, **kwargs):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(thread_name_prefix='PyForm')
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def then(self, future, callback):
+        # callback(future) runs on the pygame thread from the event loop
+        if future not in self.callbacks:
+            self.callbacks[future] = []
+            future.add_done_callback(self.completed)
+        self.callbacks[future].append(callback)
+        return future
+
+    def completed(self, future):
+        # called on a worker thread, so only hand the future over; the event
+        # wakes up a loop blocked in pg.event.wait
+        self.done.append(future)
+        try:
+            pg.event.post(pg.event.Event(TASK_DONE))
+        except pg.error:
+            pass
+
+    def poll(self):
+        while self.done:
+            future = self.done.popleft()
+            for callback in self.callbacks.pop(future, ()):
+                callback(future)
+
+    def handle_event(self, event):
+        if event.type != TASK_DONE:
+            return False
+        self.poll()
+        return True
+
+    def shutdown(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=True)
+            self.executor = None
+
+
+tasks = Tasks()
+
+_handler_tasks = set()
+
+
+async def _awaited(awaitable):
+    return await awaitable
+
+
+def call_handler(handler, *args):
+    # handlers may be async def; under run_async they are scheduled as tasks
+    # on the running loop, elsewhere they are run to completion
+    result = handler(*args)
+    if not inspect.isawaitable(result):
+        return result
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_awaited(result))
+    task = asyncio.ensure_future(result)
+    _handler_tasks.add(task)
+    task.add_done_callback(_handler_tasks.discard)
+    return task
+
+
+async def pump_events(handle_events, running, fps=60):
+    frame = 1 / fps
+    while running():
+        start = perf_counter()
+        events = pg.event.get()
+        if events:
+            handle_events(events)
+        # always yield, even when the frame ran over
+        await asyncio.sleep(max(frame - (perf_counter() - start), 0))
+
+
+def newline_offsets(text, base=0):
+    offsets = []
+    i = text.find("\n")
+    while i != -1:
+        offsets.append(base + i + 1)
+        i = text.find("\n", i + 1)
+    return offsets
+
+
+class OffsetIndex:
+    # Sorted offsets kept in blocks. Each block stores its entries relative to
+    # a base, the block's first offset, and `ends` holds the running entry
+    # count; lookups bisect the bases and then one block. Shifting every entry
+    # after an edit rewrites one block tail and the list of bases, so edits
+    # never walk the whole index in Python.
+    block_size = 512
+
+    def __init__(self, offsets=()):
+        self.bases = []
+        self.blocks = []
+        self.ends = []
+        offsets = list(offsets)
+        for i in range(0, len(offsets), self.block_size):
+            self.append_block(offsets[i:i + self.block_size])
+
+    def append_block(self, offsets):
+        base = offsets[0]
+        self.bases.append(base)
+        self.blocks.append([offset - base for offset in offsets])
+        self.ends.append((self.ends[-1] if self.ends else 0) + len(offsets))
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def locate(self, i):
+        k = bisect_right(self.ends, i)
+        return k, i - (self.ends[k - 1] if k else 0)
+
+    def __getitem__(self, i):
+        k, j = self.locate(i)
+        return self.bases[k] + self.blocks[k][j]
+
+    def bisect_right(self, offset):
+        k = bisect_right(self.bases, offset) - 1
+        if k < 0:
+            return 0
+        return (self.ends[k - 1] if k else 0) + bisect_right(self.blocks[k], offset - self.bases[k])
+
+    def shift(self, i, delta):
+        # adds delta to the entries from index i on
+        if not delta or i >= len(self):
+            return
+        k, j = self.locate(i)
+        if j:
+            block = self.blocks[k]
+            block[j:] = [offset + delta for offset in block[j:]]
+            k += 1
+        self.bases[k:] = [base + delta for base in self.bases[k:]]
+
+    def count_changed(self, k, delta):
+        self.ends[k:] = [end + delta for end in self.ends[k:]]
+
+    def rebase(self, k):
+        block = self.blocks[k]
+        first = block[0]
+        if first:
+            self.bases[k] += first
+            block[:] = [offset - first for offset in block]
+
+    def insert(self, i, offsets):
+        if not offsets:
+            return
+        if not self.blocks:
+            for start in range(0, len(offsets), self.block_size):
+                self.append_block(offsets[start:start + self.block_size])
+            return
+        k, j = self.locate(i)
+        if k == len(self.blocks) or (j == 0 and k > 0):
+            # at a block boundary the entries go to the end of the earlier block
+            k -= 1
+            j = len(self.blocks[k])
+        base = self.bases[k]
+        block = self.blocks[k]
+        block[j:j] = [offset - base for offset in offsets]
+        self.count_changed(k, len(offsets))
+        if j == 0:
+            self.rebase(k)
+        while len(block) > 2 * self.block_size:
+            tail = block[self.block_size:]
+            del block[self.block_size:]
+            tail_base = self.bases[k] + tail[0]
+            self.bases.insert(k + 1, tail_base)
+            self.blocks.insert(k + 1, [offset - tail[0] for offset in tail])
+            self.ends.insert(k, self.ends[k] - len(tail))
+            k += 1
+            block = self.blocks[k]
+
+    def delete(self, i, j):
+        # removes the entries with index i <= index < j
+        while i < j and i < len(self):
+            k, p = self.locate(i)
+            block = self.blocks[k]
+            take = min(j - i, len(block) - p)
+            del block[p:p + take]
+            self.count_changed(k, -take)
+            if not block:
+                del self.bases[k], self.blocks[k], self.ends[k]
+            elif p == 0:
+                self.rebase(k)
+            j -= take
+
+
+class PieceTable:
+    read_only = False
+    chunk_size = 4096
+
+    def __init__(self, text=""):
+        self.buffers = [text]
+        self.pieces = [(0, 0, len(text))] if text else []
+        self.starts = OffsetIndex([0] if text else [])
+        self.length = len(text)
+        self._text = text
+        self.line_starts = OffsetIndex([0] + newline_offsets(text))
+
+    def line_count(self):
+        return len(self.line_starts)
+
+    def line_start(self, row):
+        return self.line_starts[row]
+
+    def line_end(self, row):
+        if row + 1 < len(self.line_starts):
+            return self.line_start(row + 1) - 1
+        return self.length
+
+    def line_length(self, row):
+        return self.line_end(row) - self.line_start(row)
+
+    def line(self, row):
+        return self.substring(self.line_start(row), self.line_end(row))
+
+    def row_of(self, offset):
+        return self.line_starts.bisect_right(offset) - 1
+
+    def position(self, offset):
+        offset = min(max(offset, 0), self.length)
+        row = self.row_of(offset)
+        return row, offset - self.line_start(row)
+
+    def offset(self, row, col):
+        row = min(max(row, 0), len(self.line_starts) - 1)
+        return self.line_start(row) + min(max(col, 0), self.line_length(row))
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.get_text()
+
+    def get_text(self):
+        if self._text is None:
+            self._text = "".join(self.buffers[b][s:s + n] for (b, s, n) in self.pieces)
+        return self._text
+
+    def find(self, offset):
+        if offset >= self.length:
+            return len(self.pieces), 0
+        i = self.starts.bisect_right(offset) - 1
+        return i, offset - self.starts[i]
+
+    def substring(self, start, end):
+        start = max(start, 0)
+        end = min(end, self.length)
+        if start >= end:
+            return ""
+        if self._text is not None:
+            return self._text[start:end]
+        i, inner = self.find(start)
+        parts = []
+        while start < end:
+            b, s, n = self.pieces[i]
+            take = min(n - inner, end - start)
+            parts.append(self.buffers[b][s + inner:s + inner + take])
+            start += take
+            inner = 0
+            i += 1
+        return "".join(parts)
+
+    def _append(self, text):
+        if len(self.buffers) == 1 or len(self.buffers[-1]) + len(text) > self.chunk_size:
+            self.buffers.append(text)
+            return len(self.buffers) - 1, 0
+        start = len(self.buffers[-1])
+        self.buffers[-1] += text
+        return len(self.buffers) - 1, start
+
+    def _merge(self, i):
+        # joins piece i to the one before it when they are contiguous in the
+        # same buffer, so undoing an edit does not leave the table split
+        if 0 < i < len(self.pieces):
+            pb, ps, pn = self.pieces[i - 1]
+            b, s, n = self.pieces[i]
+            if pb == b and ps + pn == s:
+                self.pieces[i - 1:i + 1] = [(b, ps, pn + n)]
+                self.starts.delete(i, i + 1)
+
+    def insert(self, offset, text):
+        if not text:
+            return
+        offset = min(max(offset, 0), self.length)
+        b, s = self._append(text)
+        n = len(text)
+        i, inner = self.find(offset)
+        if inner == 0:
+            self.starts.shift(i, n)
+            if i > 0 and self.pieces[i - 1][0] == b and self.pieces[i - 1][1] + self.pieces[i - 1][2] == s:
+                pb, ps, pn = self.pieces[i - 1]
+                self.pieces[i - 1] = (pb, ps, pn + n)
+            else:
+                self.pieces.insert(i, (b, s, n))
+                self.starts.insert(i, [offset])
+        else:
+            pb, ps, pn = self.pieces[i]
+            self.pieces[i:i + 1] = [(pb, ps, inner), (b, s, n), (pb, ps + inner, pn - inner)]
+            self.starts.shift(i + 1, n)
+            self.starts.insert(i + 1, [offset, offset + n])
+        self.length += n
+        self._text = None
+        row = self.row_of(offset)
+        self.line_starts.shift(row + 1, n)
+        self.line_starts.insert(row + 1, newline_offsets(text, offset))
+
+    def delete(self, offset, length):
+        offset = max(offset, 0)
+        end = min(offset + length, self.length)
+        if offset >= end:
+            return
+        row = self.row_of(offset)
+        end_row = self.row_of(end)
+        self.line_starts.delete(row + 1, end_row + 1)
+        self.line_starts.shift(row + 1, offset - end)
+        i, inner = self.find(offset)
+        j, inner_end = self.find(end - 1)
+        replacement = []
+        if inner > 0:
+            b, s, n = self.pieces[i]
+            replacement.append((b, s, inner))
+        b, s, n = self.pieces[j]
+        if inner_end + 1 < n:
+            replacement.append((b, s + inner_end + 1, n - inner_end - 1))
+        self.pieces[i:j + 1] = replacement
+        self.starts.delete(i, j + 1)
+        self.starts.shift(i, offset - end)
+        self.starts.insert(i, ([offset - inner] if inner > 0 else []) + ([offset] if inner_end + 1 < n else []))
+        self.length -= end - offset
+        self._text = None
+        self._merge(i + len(replacement))
+        self._merge(i)
+
+
+def load_text_buffer(path, encoding='utf-8'):
+    with open(path, encoding=encoding, newline='') as f:
+        return PieceTable(f.read().replace("\r\n", "\n"))
+
+
+class MappedBuffer:
+    # Read-only view of a file with the line interface of PieceTable. Only a
+    # checkpoint every `stride` lines is kept; the starts inside a block and
+    # decoded lines are rebuilt on demand from the mapping. Offsets are the
+    # byte offset of a line start plus a column in characters, which keeps
+    # them ordered without decoding the file.
+    read_only = True
+    stride = 64
+    chunk_size = 1 << 22
+
+    def __init__(self, path, encoding='utf-8'):
+        self.path = path
+        self.encoding = encoding
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.length = size
+        self.blocks = OrderedDict()
+        self.lines = OrderedDict()
+        self.index()
+
+    def index(self):
+        # one streaming pass over the mapping; split and accumulate keep the
+        # per-line work in C
+        self.checkpoints = array('q', [0])
+        self.total = 1
+        self.longest = (0, 0)
+        carry = 0
+        for base in range(0, self.length, self.chunk_size):
+            pieces = self.data[base:base + self.chunk_size].split(b"\n")
+            count = len(pieces) - 1
+            lengths = list(map(len, pieces))
+            lengths[0] += carry
+            carry = lengths[-1]
+            if count:
+                longest = max(lengths[:-1])
+                if longest > self.longest[1]:
+                    self.longest = (self.total - 1 + lengths.index(longest), longest)
+                starts = accumulate(map((1).__add__, map(len, pieces[:-1])), initial=base)
+                self.checkpoints.extend(islice(starts, 1 + (-self.total) % self.stride, None, self.stride))
+                self.total += count
+        if carry > self.longest[1]:
+            self.longest = (self.total - 1, carry)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def block(self, k):
+        starts = self.blocks.get(k)
+        if starts is None:
+            start = self.checkpoints[k]
+            if k + 1 < len(self.checkpoints):
+                end, count = self.checkpoints[k + 1], self.stride - 1
+            else:
+                end, count = self.length, self.total - 1 - k * self.stride
+            pieces = self.data[start:end].split(b"\n")[:count]
+            starts = self.blocks[k] = list(accumulate(map((1).__add__, map(len, pieces)), initial=start))
+            if len(self.blocks) > 32:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(k)
+        return starts
+
+    def line_count(self):
+        return self.total
+
+    def longest_row(self):
+        return self.longest[0]
+
+    def line_start(self, row):
+        return self.block(row // self.stride)[row % self.stride]
+
+    def line_end(self, row):
+        # in bytes
+        if row + 1 >= self.total:
+            return self.length
+        end = self.line_start(row + 1) - 1
+        if end > self.line_start(row) and self.data[end - 1] == 13:
+            end -= 1
+        return end
+
+    def line(self, row):
+        line = self.lines.get(row)
+        if line is None:
+            line = self.lines[row] = self.data[self.line_start(row):self.line_end(row)].decode(self.encoding,
+                                                                                                'replace')
+            if len(self.lines) > 256:
+                self.lines.popitem(last=False)
+        else:
+            self.lines.move_to_end(row)
+        return line
+
+    def line_length(self, row):
+        return len(self.line(row))
+
+    def row_of(self, offset):
+        k = bisect_right(self.checkpoints, offset) - 1
+        return k * self.stride + bisect_right(self.block(k), offset) - 1
+
+    def position(self, offset):
+        offset = min(max(offset, 0), self.length)
+        row = self.row_of(offset)
+        return row, min(offset - self.line_start(row), self.line_length(row))
+
+    def offset(self, row, col):
+        row = min(max(row, 0), self.total - 1)
+        return self.line_start(row) + min(max(col, 0), self.line_length(row))
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.get_text()
+
+    def get_text(self):
+        return self.data[:].decode(self.encoding, 'replace').replace("\r\n", "\n")
+
+    def insert(self, offset, text):
+        raise ValueError("%s is opened read-only" % self.path)
+
+    def delete(self, offset, length):
+        raise ValueError("%s is opened read-only" % self.path)
+
+
+class LongestLine:
+    # stands in for LineWidths on read-only buffers, where measuring every
+    # line would read the whole file
+    def __init__(self, row, width):
+        self.row = row
+        self.width = width
+
+    def max(self):
+        return self.width
+
+    def longest_row(self):
+        return self.row
+
+
+class EditLog:
+    # Undo history of a text buffer as (kind, offset, text) operations that
+    # hold only the inserted or removed text. Typing or deleting at adjacent
+    # offsets grows the last operation instead of adding one; once the kept
+    # text passes `budget` bytes the oldest operations are dropped.
+    INSERT = 0
+    DELETE = 1
+    entry_size = 64
+    run_limit = 1024
+
+    def __init__(self, budget=1 << 22):
+        self.budget = budget
+        self.undo_ops = deque()
+        self.redo_ops = []
+        self.size = 0
+        self.sealed = True
+
+    def cost(self, text):
+        return sys.getsizeof(text) + self.entry_size
+
+    def inserted(self, offset, text):
+        self.record(self.INSERT, offset, text)
+
+    def deleted(self, offset, text):
+        self.record(self.DELETE, offset, text)
+
+    def record(self, kind, offset, text):
+        if not text:
+            return
+        for op in self.redo_ops:
+            self.size -= self.cost(op[2])
+        self.redo_ops.clear()
+        op = (kind, offset, text)
+        last = self.undo_ops[-1] if self.undo_ops and not self.sealed else None
+        if last is not None and last[0] == kind and "\n" not in text and len(last[2]) + len(text) <= self.run_limit:
+            if kind == self.INSERT and offset == last[1] + len(last[2]):
+                op = (kind, last[1], last[2] + text)
+            elif kind == self.DELETE and offset + len(text) == last[1]:
+                op = (kind, offset, text + last[2])
+            elif kind == self.DELETE and offset == last[1]:
+                op = (kind, offset, last[2] + text)
+        if op[2] is not text:
+            self.size -= self.cost(self.undo_ops.pop()[2])
+        self.undo_ops.append(op)
+        self.size += self.cost(op[2])
+        self.sealed = "\n" in text
+        while self.size > self.budget and self.undo_ops:
+            self.size -= self.cost(self.undo_ops.popleft()[2])
+
+    def seal(self):
+        # the next edit starts a new operation even if it is adjacent
+        self.sealed = True
+
+    def can_undo(self):
+        return bool(self.undo_ops)
+
+    def can_redo(self):
+        return bool(self.redo_ops)
+
+    def undo(self):
+        if not self.undo_ops:
+            return None
+        op = self.undo_ops.pop()
+        self.redo_ops.append(op)
+        self.sealed = True
+        return op
+
+    def redo(self):
+        if not self.redo_ops:
+            return None
+        op = self.redo_ops.pop()
+        self.undo_ops.append(op)
+        self.sealed = True
+        return op
+
+    def clear(self):
+        self.undo_ops.clear()
+        self.redo_ops.clear()
+        self.size = 0
+        self.sealed = True
+
+
+class LineWidths:
+    def __init__(self, widths):
+        self.widths = list(widths)
+        self.counts = {}
+        for width in self.widths:
+            self.counts[width] = self.counts.get(width, 0) + 1
+        self.heap = [-width for width in self.counts]
+        heapify(self.heap)
+        # a row holding the widest line, kept in step with edits; None when
+        # the edit removed it and a scan is needed
+        self.row = None
+
+    def replace(self, row, count, widths):
+        if self.row is not None:
+            if self.row >= row + count:
+                self.row += len(widths) - count
+            elif self.row >= row:
+                self.row = None
+        for width in self.widths[row:row + count]:
+            self.counts[width] -= 1
+            if not self.counts[width]:
+                del self.counts[width]
+        self.widths[row:row + count] = widths
+        for width in widths:
+            if width not in self.counts:
+                self.counts[width] = 0
+                heappush(self.heap, -width)
+            self.counts[width] += 1
+        if len(self.heap) > 2 * len(self.counts) + 64:
+            self.heap = [-width for width in self.counts]
+            heapify(self.heap)
+        if widths:
+            widest = max(widths)
+            if widest == self.max():
+                self.row = row + widths.index(widest)
+
+    def max(self):
+        while self.heap and -self.heap[0] not in self.counts:
+            heappop(self.heap)
+        return -self.heap[0] if self.heap else 0
+
+    def longest_row(self):
+        if not self.widths:
+            return 0
+        if self.row is None or self.widths[self.row] != self.max():
+            self.row = self.widths.index(self.max())
+        return self.row
+
+
+def prefix_advances(font, text):
+    advances = [0]
+    x = 0
+    for metrics in font.metrics(text):
+        x += metrics[4] if metrics else 0
+        advances.append(x)
+    return advances
+
+
+class Canvas:
+    def __init__(self):
+        self.items = []
+        self.clip = None
+
+    def set_clip(self, rect=None):
+        self.clip = None if rect is None else tuple(rect)
+
+    def rect(self, color, rect, width=0):
+        self.items.append(('rect', self.clip, _color_key(color), tuple(rect), width))
+
+    def transparent_rect(self, color, rect):
+        self.items.append(('transparent_rect', self.clip, _color_key(color), tuple(rect)))
+
+    def line(self, color, start, end, width=1):
+        self.items.append(('line', self.clip, _color_key(color), tuple(start), tuple(end), width))
+
+    def circle(self, color, center, radius):
+        self.items.append(('circle', self.clip, _color_key(color), tuple(center), radius))
+
+    def filled_circle(self, color, center, radius):
+        self.items.append(('filled_circle', self.clip, _color_key(color), tuple(center), radius))
+
+    def text(self, text, font, pos, color, background=None):
+        self.items.append(('text', self.clip, text, font, tuple(pos), _color_key(color), _color_key(background)))
+
+    def text_rect(self, text, font, rect, color, background=None):
+        text_size = font.size(text)
+        self.text(text, font, (rect[0] + (rect[2] - text_size[0]) // 2, rect[1] + (rect[3] - text_size[1]) // 2),
+                  color, background)
+
+    def blit(self, surface, pos, area=None):
+        self.items.append(('blit', self.clip, surface, tuple(pos), None if area is None else tuple(area)))
+
+
+def item_bounds(item):
+    kind = item[0]
+    if kind in ('rect', 'transparent_rect'):
+        bounds = pg.Rect(item[3])
+    elif kind == 'text':
+        bounds = pg.Rect(item[4], item[3].size(item[2]))
+    elif kind == 'line':
+        (x1, y1), (x2, y2), width = item[3], item[4], item[5]
+        bounds = pg.Rect(min(x1, x2), min(y1, y2), abs(x2 - x1) + 1, abs(y2 - y1) + 1).inflate(width * 2, width * 2)
+    elif kind in ('circle', 'filled_circle'):
+        (x, y), radius = item[3], item[4]
+        bounds = pg.Rect(x - radius, y - radius, radius * 2 + 1, radius * 2 + 1)
+    else:
+        bounds = pg.Rect(item[3], item[4][2:] if item[4] is not None else item[2].get_size())
+    return bounds.clip(item[1]) if item[1] is not None else bounds
+
+
+def paint_item(surface, item):
+    kind = item[0]
+    if kind == 'rect':
+        if item[4] > 0:
+            # outlines are painted as four filled edges: pygame fills an
+            # outline solid when the clip is only a couple of pixels wide
+            left, top, width, height = item[3]
+            edge = min(item[4], width, height)
+            for side in ((left, top, width, edge), (left, top + height - edge, width, edge),
+                         (left, top, edge, height), (left + width - edge, top, edge, height)):
+                pg.draw.rect(surface, item[2], side)
+        else:
+            pg.draw.rect(surface, item[2], item[3])
+    elif kind == 'text':
+        surface.blit(text_cache.render(item[3], item[2], item[5], item[6]), item[4])
+    elif kind == 'transparent_rect':
+        rect_transparent(surface, item[2], pg.Rect(item[3]))
+    elif kind == 'line':
+        pg.draw.line(surface, item[2], item[3], item[4], item[5])
+    elif kind == 'circle':
+        pg.gfxdraw.circle(surface, item[3][0], item[3][1], item[4], item[2])
+    elif kind == 'filled_circle':
+        pg.gfxdraw.filled_circle(surface, item[3][0], item[3][1], item[4], item[2])
+    elif kind == 'blit':
+        surface.blit(item[2], item[3], item[4])
+
+
+class DisplayList:
+    def __init__(self, surface, on_damage):
+        self.surface = surface
+        self.on_damage = on_damage
+        self.nodes = {}
+        self.roots = []
+        self.stack = []
+        self.damaged = DirtyRects()
+        # keys lifted onto a DragLayer, and the layer being recorded into
+        self.layers = {}
+        self.target = None
+
+    @contextmanager
+    def record(self, key, root=False):
+        layer = self.target or self.layers.get(key)
+        if layer is not None:
+            if self.stack and self.target is None:
+                # the parent keeps referring to the node; it is drawn by the layer
+                self.stack[-1].items.append(('child', key))
+            target, self.target = self.target, layer
+            try:
+                with layer.record(key, root=key == layer.key) as canvas:
+                    yield canvas
+            finally:
+                self.target = target
+            return
+        canvas = Canvas()
+        if self.stack:
+            self.stack[-1].items.append(('child', key))
+        elif root and key not in self.roots:
+            self.roots.append(key)
+        self.stack.append(canvas)
+        try:
+            yield canvas
+        finally:
+            self.stack.pop()
+            self.commit(key, canvas.items, attached=root or bool(self.stack))
+
+    def commit(self, key, items, attached=True):
+        old = self.nodes.get(key)
+        if old is None and not attached:
+            # the parent did not draw this control last time, so it is hidden
+            return
+        old_items, old_bounds = old if old is not None else ([], [])
+        if old_items == items:
+            return
+        bounds_by_item = dict(zip(old_items, old_bounds))
+        new_items = set(items)
+        for item, bounds in zip(old_items, old_bounds):
+            if item not in new_items:
+                if bounds is None:
+                    self.remove(item[1])
+                else:
+                    self.damaged.add(bounds)
+        bounds = []
+        for item in items:
+            if item[0] == 'child':
+                bounds.append(None)
+            elif item in bounds_by_item:
+                bounds.append(bounds_by_item[item])
+            else:
+                bounds.append(item_bounds(item))
+                self.damaged.add(bounds[-1])
+        if set(old_items) == new_items:
+            for rect in bounds:
+                if rect is not None:
+                    self.damaged.add(rect)
+        self.nodes[key] = (items, bounds)
+
+    def remove(self, key):
+        if key in self.layers:
+            self.drop(self.layers[key].key)
+        node = self.nodes.pop(key, None)
+        if key in self.roots:
+            self.roots.remove(key)
+        if node is not None:
+            for item, bounds in zip(*node):
+                if bounds is None:
+                    self.remove(item[1])
+                else:
+                    self.damaged.add(bounds)
+
+    def damage(self, rect):
+        self.damaged.add(rect)
+
+    def lift(self, key, area):
+        # moves the node of key and its children onto a layer drawn above the
+        # rest of the list until drop(key); the node itself stays as an empty
+        # placeholder so the parent's reference to it is kept
+        if key not in self.nodes or key in self.layers:
+            return None
+        layer = DragLayer(self, key, area)
+        self.take(key, layer)
+        self.nodes[key] = ([], [])
+        self.flush()
+        layer.cache()
+        layer.damaged.rects.extend(self.layer_bounds(layer))
+        for lifted in layer.nodes:
+            self.layers[lifted] = layer
+        return layer
+
+    def take(self, key, layer):
+        node = layer.nodes[key] = self.nodes.pop(key)
+        for item, bounds in zip(*node):
+            if bounds is None:
+                self.take(item[1], layer)
+            else:
+                self.damaged.add(bounds)
+
+    def layer_bounds(self, layer):
+        return [bounds for items, rects in layer.nodes.values() for bounds in rects if bounds is not None]
+
+    def drop(self, key):
+        layer = self.layers.get(key)
+        if layer is None or layer.key != key:
+            return
+        for lifted in [lifted for lifted, owner in self.layers.items() if owner is layer]:
+            del self.layers[lifted]
+        self.nodes.update(layer.nodes)
+        self.damaged.rects.extend(layer.damaged.rects)
+        self.damaged.rects.extend(self.layer_bounds(layer))
+
+    def paint(self, key, rect):
+        node = self.nodes.get(key)
+        if node is None:
+            return
+        for item, bounds in zip(*node):
+            if bounds is None:
+                self.paint(item[1], rect)
+            elif bounds.colliderect(rect):
+                self.surface.set_clip(rect.clip(item[1]) if item[1] is not None else rect)
+                paint_item(self.surface, item)
+
+    def replay(self, rect):
+        for key in self.roots:
+            self.paint(key, rect)
+        self.surface.set_clip(None)
+
+    def flush(self):
+        if self.damaged.rects:
+            bounds = self.surface.get_rect()
+            layers = set(self.layers.values())
+            for rect in self.damaged.merged():
+                rect = rect.clip(bounds)
+                if rect.width and rect.height:
+                    self.replay(rect)
+                    for layer in layers:
+                        layer.underlay_changed(rect)
+                    self.on_damage(rect)
+            self.damaged.clear()
+        for layer in set(self.layers.values()):
+            layer.flush()
+
+
+class DragLayer(DisplayList):
+    # Draws a lifted control above the rest of its display list. What lies
+    # beneath is copied once when the drag starts and only refreshed where the
+    # list itself redraws, so moving the control never replays other nodes.
+    def __init__(self, owner, key, area):
+        super().__init__(owner.surface, owner.on_damage)
+        self.key = key
+        self.roots.append(key)
+        self.area = pg.Rect(area).clip(owner.surface.get_rect())
+        self.background = None
+
+    def cache(self):
+        self.background = self.surface.subsurface(self.area).copy()
+
+    def underlay_changed(self, rect):
+        rect = rect.clip(self.area)
+        if rect.width and rect.height:
+            self.background.blit(self.surface, rect.move(-self.area.left, -self.area.top), rect)
+            self.replay(rect)
+
+    def flush(self):
+        if not self.damaged.rects:
+            return
+        for rect in self.damaged.merged():
+            rect = rect.clip(self.area)
+            if rect.width and rect.height:
+                self.surface.blit(self.background, rect, rect.move(-self.area.left, -self.area.top))
+                self.replay(rect)
+                self.on_damage(rect)
+        self.damaged.clear()
+
+
+@contextmanager
+def detached_canvas():
+    yield Canvas()
+
+
+class SpatialIndex:
+    cell_size = 64
+
+    def __init__(self, controls):
+        self.cells = {}
+        self.bounds = {}
+        self.order = {}
+        self.next_order = 0
+        self.active = set()
+        for control in controls:
+            self.add(control)
+
+    def cells_for(self, bounds):
+        left, top, width, height = bounds
+        if width <= 0 or height <= 0:
+            return []
+        size = self.cell_size
+        return [(x, y) for x in range(int(left) // size, int(left + width - 1) // size + 1)
+                for y in range(int(top) // size, int(top + height - 1) // size + 1)]
+
+    def add(self, control):
+        self.order[control] = self.next_order
+        self.next_order += 1
+        self.update(control)
+        self.activity_changed(control)
+
+    def remove(self, control):
+        for cell in self.cells_for(self.bounds.pop(control, (0, 0, 0, 0))):
+            controls = self.cells[cell]
+            controls.remove(control)
+            if not controls:
+                del self.cells[cell]
+        self.order.pop(control, None)
+        self.active.discard(control)
+
+    def replace(self, old, new):
+        # new takes over the cells and stacking order of old
+        if old not in self.order:
+            return
+        bounds = self.bounds.pop(old)
+        for cell in self.cells_for(bounds):
+            controls = self.cells[cell]
+            controls[controls.index(old)] = new
+        self.order[new] = self.order.pop(old)
+        self.bounds[new] = bounds
+        self.active.discard(old)
+        self.update(new)
+        self.activity_changed(new)
+
+    def update(self, control):
+        if control not in self.order:
+            return
+        bounds = (control.left, control.top, control.width, control.height)
+        old_bounds = self.bounds.get(control, (0, 0, 0, 0))
+        if bounds == old_bounds:
+            return
+        for cell in self.cells_for(old_bounds):
+            controls = self.cells[cell]
+            controls.remove(control)
+            if not controls:
+                del self.cells[cell]
+        self.bounds[control] = bounds
+        for cell in self.cells_for(bounds):
+            self.cells.setdefault(cell, []).append(control)
+
+    def activity_changed(self, control):
+        if control in self.order and (control.focused or control.mouse_over):
+            self.active.add(control)
+        else:
+            self.active.discard(control)
+
+    def query(self, x, y):
+        return self.cells.get((int(x) // self.cell_size, int(y) // self.cell_size), ())
+
+    def candidates(self, pos=None):
+        controls = set(self.active)
+        if pos is not None:
+            controls.update(self.query(*pos))
+        return sorted(controls, key=self.order.__getitem__)
+
+
+class Style:
+    # fonts and colors shared by reference between controls; styles are
+    # interned, so controls that look alike point at the same object
+    __slots__ = ('font_name', 'font_size', 'font_bold', 'font_italic', 'color', 'background', '_font')
+    styles = {}
+
+    def __init__(self, font_name, font_size, font_bold, font_italic, color, background):
+        self.font_name = font_name
+        self.font_size = font_size
+        self.font_bold = font_bold
+        self.font_italic = font_italic
+        self.color = color
+        self.background = background
+        self._font = None
+
+    @classmethod
+    def get(cls, font_name='Courier', font_size=18, font_bold=False, font_italic=False, color=None, background=None):
+        key = (font_name, font_size, bool(font_bold), bool(font_italic), _color_key(color), _color_key(background))
+        style = cls.styles.get(key)
+        if style is None:
+            style = cls.styles[key] = cls(font_name, font_size, bool(font_bold), bool(font_italic),
+                                          None if color is None else pg.Color(color),
+                                          None if background is None else pg.Color(background))
+        return style
+
+    def replace(self, **changes):
+        fields = dict(font_name=self.font_name, font_size=self.font_size, font_bold=self.font_bold,
+                      font_italic=self.font_italic, color=self.color, background=self.background)
+        fields.update(changes)
+        return Style.get(**fields)
+
+    @property
+    def font(self):
+        if self._font is None:
+            self._font = get_font(self.font_name, self.font_size, self.font_bold, self.font_italic)
+        return self._font
 
 
 class Control:
+    __slots__ = ('form', 'style', 'loading', '_controls', '_parent', '_left', '_top', '_width', '_height', '_rect',
+                 '_index', '_focused', '_mouse_over', '__weakref__')
+    default_size = (0, 0)
+
     def __init__(self, form=None, parent=None, left=0, top=0, width=0, height=0):
+        # leaves never allocate a child list; see controls and add_control
+        self._controls = None
+        self._parent = None
+        self._left = self._top = self._width = self._height = 0
+        self._rect = None
+        self._index = None
+        self._focused = self._mouse_over = False
+        self.loading = False
+        self.style = Style.get()
         self.form = form
         self.parent = parent if parent is not None else form
         self.left = left
         self.top = top
         self.width = width
         self.height = height
-        self.mouse_over = False
-        self.focused = False
-        self.font_name = None
-        self.font_size = None
-        self.set_font('Courier', 18)
-        self.controls = []
+
+    @property
+    def controls(self):
+        return self._controls if self._controls is not None else ()
+
+    @property
+    def font(self):
+        return self.style.font
+
+    @property
+    def color(self):
+        return self.style.color
+
+    @color.setter
+    def color(self, color):
+        self.style = self.style.replace(color=color)
+
+    @property
+    def background(self):
+        return self.style.background
+
+    @background.setter
+    def background(self, background):
+        self.style = self.style.replace(background=background)
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        if parent is not self._parent:
+            if self._parent is not None and self._parent._index is not None:
+                self._parent._index.remove(self)
+            self._parent = parent
+            self.geometry_changed()
+
+    @property
+    def left(self):
+        return self._left
+
+    @left.setter
+    def left(self, left):
+        if left != self._left:
+            self._left = left
+            self.moved()
+
+    @property
+    def top(self):
+        return self._top
+
+    @top.setter
+    def top(self, top):
+        if top != self._top:
+            self._top = top
+            self.moved()
+
+    @property
+    def width(self):
+        return self._width
+
+    @width.setter
+    def width(self, width):
+        if width != self._width:
+            self._width = width
+            self.moved()
+
+    @property
+    def height(self):
+        return self._height
+
+    @height.setter
+    def height(self, height):
+        if height != self._height:
+            self._height = height
+            self.moved()
+
+    @property
+    def focused(self):
+        return self._focused
+
+    @focused.setter
+    def focused(self, focused):
+        self._focused = focused
+        self.activity_changed()
+
+    @property
+    def mouse_over(self):
+        return self._mouse_over
+
+    @mouse_over.setter
+    def mouse_over(self, mouse_over):
+        self._mouse_over = mouse_over
+        self.activity_changed()
+
+    def activity_changed(self):
+        if self._parent is not None and self._parent._index is not None:
+            self._parent._index.activity_changed(self)
+
+    def moved(self):
+        self.geometry_changed()
+        if self._parent is not None and self._parent._index is not None:
+            self._parent._index.update(self)
+
+    def geometry_changed(self):
+        # a cached child rect implies a cached parent rect, so the walk can
+        # stop at the first control that has nothing cached
+        if self._rect is not None:
+            self._rect = None
+            for control in self.controls:
+                control.geometry_changed()
 
     def focuse(self):
         self.focused = True
 
+    def bind_future(self, future, apply, on_error=None):
+        # apply(result) runs on the pygame thread once the future is done,
+        # then the control redraws itself
+        self.loading = True
+
+        def done(future):
+            self.loading = False
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is None:
+                apply(future.result())
+            elif on_error is not None:
+                on_error(error)
+            else:
+                # raising here would end the event loop that dispatched it
+                logging.getLogger(__name__).error("%s: background task failed", type(self).__name__,
+                                                  exc_info=error)
+            self.render()
+            dirty_rects.update()
+        return tasks.then(future, done)
+
+    def get_display_list(self):
+        owner = self.form if self.form is not None else self.parent
+        return owner.get_display_list() if owner is not None else None
+
+    def canvas(self, key=None):
+        display_list = self.get_display_list()
+        if display_list is None:
+            return detached_canvas()
+        return display_list.record(self if key is None else key)
+
     def add_control(self, control):
-        self.controls.append(control)
+        if self._controls is None:
+            self._controls = []
+        self._controls.append(control)
         control.form = self.form
         control.parent = self
+        control.geometry_changed()
+        if self._index is not None:
+            self._index.add(control)
+        control.attached()
+
+    def attached(self):
+        # called after the control, or a container above it, was added to a
+        # parent, so state that depends on the form can be moved over
+        for control in self.controls:
+            control.attached()
+
+    def remove_control(self, control):
+        self._controls.remove(control)
+        control.parent = None
+        control.form = None
+
+    def replace_control(self, old, new):
+        # new takes the place of old in drawing and hit-testing order
+        self._controls[self._controls.index(old)] = new
+        new.form = old.form
+        new.parent = self
+        new.geometry_changed()
+        if self._index is not None:
+            self._index.replace(old, new)
+        old.parent = None
+
+    def child_index(self):
+        if self._index is None or len(self._index.order) != len(self.controls):
+            self._index = SpatialIndex(self.controls)
+        return self._index
+
+    def client_origin(self):
+        rect = self.rect()
+        return rect.left, rect.top
 
     def rect(self):
-        if self.parent:
-            if self.parent == self.form:
-                return pg.Rect(self.left + self.parent.rect().left,
-                               self.top + self.parent.rect().top + self.form.title_height, self.width,
-                               self.height)
+        # the returned rect is shared with the cache; copy it before modifying
+        if self._rect is None:
+            parent = self._parent
+            if parent:
+                parent_rect = parent.rect()
+                top = self._top + parent_rect.top
+                if parent is self.form:
+                    top += self.form.title_height
+                self._rect = pg.Rect(self._left + parent_rect.left, top, self._width, self._height)
             else:
-                return pg.Rect(self.left + self.parent.rect().left, self.top + self.parent.rect().top, self.width,
-                               self.height)
+                self._rect = pg.Rect(self._left, self._top, self._width, self._height)
+        return self._rect
 
-        else:
-            return pg.Rect(self.left, self.top, self.width, self.height)
-
-    def set_font(self, name=None, size=None):
-        if name is not None:
-            self.font_name = name
-        if size is not None:
-            self.font_size = size
-        self.font = pg.font.SysFont(self.font_name, self.font_size)
+    def set_font(self, name=None, size=None, bold=None, italic=None):
+        changes = dict(font_name=name, font_size=size, font_bold=bold, font_italic=italic)
+        self.style = self.style.replace(**{key: value for key, value in changes.items() if value is not None})
 
     def mouse_in(self, event):
         self.mouse_over = True
@@ -78,7 +1580,7 @@ class Control:
 
     def mouse_up(self, event):
         if self.rect().collidepoint(event.pos):
-            self.mouse_click(event)
+            call_handler(self.mouse_click, event)
 
     def mouse_click(self, event):
         pass
@@ -115,24 +1617,31 @@ class Control:
             self.key_down(event)
         elif event.type == pg.KEYUP:
             self.key_up(event)
-        for control in self.controls:
-            if event.type in [pg.MOUSEMOTION, pg.MOUSEBUTTONDOWN]:
+        if not self.controls:
+            return
+        if event.type in [pg.MOUSEMOTION, pg.MOUSEBUTTONDOWN]:
+            x, y = self.client_origin()
+            for control in self.child_index().candidates((event.pos[0] - x, event.pos[1] - y)):
                 if control.focused or control.mouse_over or control.rect().collidepoint(event.pos):
                     control.handle_event(event)
-            elif event.type in [pg.KEYDOWN, pg.KEYUP, pg.MOUSEBUTTONUP] and control.focused:
-                control.handle_event(event)
+        elif event.type in [pg.KEYDOWN, pg.KEYUP, pg.MOUSEBUTTONUP]:
+            for control in self.child_index().candidates():
+                if control.focused:
+                    control.handle_event(event)
 
 
 class Draggable(Control):
+    __slots__ = ('dragging', 'last_pos', 'drag_area')
+
     def __init__(self, **args):
         super().__init__(**args)
         self.dragging = False
         self.last_pos = None
-        self.covered_surf = None
+        self.drag_area = None
         self.color=pg.Color('gray')
 
     def perimeter_rect(self):
-        rect = self.parent.rect()
+        rect = self.parent.rect().copy()
         if self.form == self.parent:
             rect.top += self.form.title_height
             rect.height -= self.form.title_height
@@ -143,54 +1652,72 @@ class Draggable(Control):
         if self.rect().collidepoint(event.pos):
             self.dragging = True
             self.last_pos = event.pos
+            self.start_drag()
+
+    def start_drag(self):
+        # the perimeter cannot change while dragging, so it is worked out once
+        self.drag_area = self.perimeter_rect()
+        display_list = self.get_display_list()
+        if display_list is not None:
+            display_list.lift(self, self.drag_area)
+
+    def end_drag(self):
+        display_list = self.get_display_list()
+        if display_list is not None:
+            display_list.drop(self)
+        self.drag_area = None
 
     def mouse_move(self, event):
         super().mouse_move(event)
-        if self.dragging and self.perimeter_rect().collidepoint(event.pos):
+        if not self.dragging:
+            return
+        perimeter = self.drag_area
+        if perimeter.collidepoint(event.pos):
             offset_x, offset_y = event.pos[0] - self.last_pos[0], event.pos[1] - self.last_pos[1]
-            if self.perimeter_rect().left > self.rect().left + offset_x or \
-                    self.rect().right + offset_x > self.perimeter_rect().right:
+            rect = self.rect()
+            if perimeter.left > rect.left + offset_x or rect.right + offset_x > perimeter.right:
                 offset_x=0
-            if self.perimeter_rect().top > self.rect().top + offset_y or \
-                    self.rect().bottom + offset_y > self.perimeter_rect().bottom:
+            if perimeter.top > rect.top + offset_y or rect.bottom + offset_y > perimeter.bottom:
                 offset_y=0
             self.last_pos = event.pos
-            self.dragged(offset_x, offset_y)
+            if offset_x or offset_y:
+                self.dragged(offset_x, offset_y)
 
     def mouse_up(self, event):
         super().mouse_up(event)
-        self.dragging = False
+        if self.dragging:
+            self.dragging = False
+            self.end_drag()
 
     def render(self):
-        if not self.covered_surf:
-            self.covered_surf = self.form.screen.subsurface(self.rect()).copy()
-        pg.draw.rect(self.form.screen, self.color, self.rect())
+        with self.canvas() as canvas:
+            canvas.rect(self.color, self.rect())
 
     def dragged(self, offset_x, offset_y):
-        self.form.screen.blit(self.covered_surf, (self.rect().left, self.rect().top))
         self.left += offset_x
         self.top += offset_y
-        self.covered_surf = self.form.screen.subsurface(self.rect()).copy()
         self.render()
 
 
 class Label(Control):
+    __slots__ = ('text',)
+
     def __init__(self, form=None, left=0, top=0, width=0, height=0, text=""):
         super().__init__(form=form, left=left, top=top, width=width, height=height)
         self.text = text.replace("\r\n", "\n")
         self.color = pg.Color('black')
         self.background = pg.Color('white')
-        self.surface = None
 
     def render(self):
         if self.form is not None:
-            self.form.screen.set_clip(self.rect())
-            render_text_pos(screen=self.form.screen, font=self.font, text=self.text, color=self.color,
-                            pos=(self.rect().left, self.rect().top))
-            self.form.screen.set_clip(None)
+            with self.canvas() as canvas:
+                canvas.set_clip(self.rect())
+                canvas.text(self.text, self.font, self.rect().topleft, self.color)
 
 
 class Button(Label):
+    __slots__ = ()
+
     def __init__(self, form=None, left=0, top=0, width=0, height=0, text=""):
         super().__init__(form=form, left=left, top=top, width=width, height=height, text=text)
         self.background = pg.Color('gray')
@@ -198,12 +1725,13 @@ class Button(Label):
     def render(self, down=False):
         if self.form is not None:
             rect = self.rect()
-            if not down:
-                pg.draw.rect(self.form.screen, self.background, rect)
-            else:
-                pg.draw.rect(self.form.screen, pg.Color('white'), rect)
-            render_text_rect(screen=self.form.screen, font=self.font, text=self.text, color=self.color, rect=rect)
-            pg.draw.rect(self.form.screen, pg.Color('black'), rect, 1)
+            with self.canvas() as canvas:
+                if not down:
+                    canvas.rect(self.background, rect)
+                else:
+                    canvas.rect(pg.Color('white'), rect)
+                canvas.text_rect(self.text, self.font, rect, self.color)
+                canvas.rect(pg.Color('black'), rect, 1)
 
     def mouse_down(self, event):
         super().mouse_down(event)
@@ -219,6 +1747,8 @@ class Button(Label):
 
 
 class ScrollBarHandle(Draggable):
+    __slots__ = ('handle_size', 'handle_width', 'orientation', 'max')
+
     def __init__(self, form=None, parent=None, left=0, top=0, handle_width=10, handle_size=10, orientation=0, max=100):
         super().__init__(form=form, parent=parent, left=left, top=top)
         self.handle_size=handle_size
@@ -260,6 +1790,8 @@ class ScrollBarHandle(Draggable):
                 self.top=int(self.max*pc)
 
 class ScrollBar(Control):
+    __slots__ = ('bar_width', 'min', 'max', 'current', 'view_port', 'length', 'handle', 'track', 'track_color')
+
     def __init__(self, form=None, parent=None, left=0, top=0, width=10, length=100, orientation=0, min=0, max=100,
                  current=0, view_port=10):
         self.bar_width = width
@@ -268,6 +1800,8 @@ class ScrollBar(Control):
         self.current = current
         self.view_port = view_port
         self.length = length
+        self.track = None
+        self.track_color = (200, 200, 200, 100)
 
         if orientation == 0:  # 0: Horizontal 1: Vertical
             width = length
@@ -283,13 +1817,22 @@ class ScrollBar(Control):
     def handle_size(self):
         if self.view_port >= self.max - self.min:
             return 0
-        return int(self.view_port / (self.max - self.min) * self.length)
+        # keep the handle grabbable when the range is much larger than the view
+        return max(int(self.view_port / (self.max - self.min) * self.length), min(self.bar_width, self.length))
 
     def render(self):
-        rect_transparent(self.form.screen, (200, 200, 200, 100), self.rect())
-        self.handle.handle_size=self.handle_size()
-        self.handle.max=self.length-self.handle.handle_size
-        self.handle.render()
+        with self.canvas() as canvas:
+            canvas.blit(self.track_surface(), self.rect().topleft)
+            self.handle.handle_size=self.handle_size()
+            self.handle.max=self.length-self.handle.handle_size
+            self.handle.render()
+
+    def track_surface(self):
+        # looked up again only when the bar is resized; bars of the same size
+        # share one surface
+        if self.track is None or self.track.get_size() != (self.width, self.height):
+            self.track = overlay_cache.get((self.width, self.height), self.track_color)
+        return self.track
 
     def scrolled(self,pc):
         self.parent.scrolled(self,pc)
@@ -299,6 +1842,10 @@ class ScrollBar(Control):
         self.render()
 
 class TextBox(Label):
+    __slots__ = ('padding_left', 'padding_right', 'padding_top', 'padding_bottom', 'caret_row', 'caret_col',
+                 'first_visible_col', 'first_visible_row', 'multilines', 'scrollbar_width', 'advances_cache',
+                 'hscrollbar', 'vscrollbar', 'buffer', 'widths', 'history')
+
     def __init__(self, form=None, left=0, top=0, width=0, height=0, text="", multilines=False):
         super().__init__(form=form, left=left, top=top, width=width, height=height, text=text)
         self.padding_left = 2
@@ -311,6 +1858,7 @@ class TextBox(Label):
         self.first_visible_row = 0
         self.multilines = multilines
         self.scrollbar_width = 10
+        self.advances_cache = OrderedDict()
         if self.multilines:
             self.hscrollbar = ScrollBar(form=form, parent=self, left=1, top=self.height - self.scrollbar_width -1,
                                         width=self.scrollbar_width, length=self.width - self.scrollbar_width -2,
@@ -323,6 +1871,45 @@ class TextBox(Label):
         else:
             self.hscrollbar = self.vscrollbar = None
 
+    @property
+    def text(self):
+        return self.buffer.get_text()
+
+    @text.setter
+    def text(self, text):
+        self.set_buffer(PieceTable(text.replace("\r\n", "\n")))
+
+    def set_buffer(self, buffer):
+        old = getattr(self, 'buffer', None)
+        if old is not None and old is not buffer and hasattr(old, 'close'):
+            # a replaced mapped file gives its descriptor and mapping back now
+            old.close()
+        self.buffer = buffer
+        self.widths = None
+        self.history = EditLog()
+        self.caret_row = self.caret_col = 0
+        self.first_visible_row = self.first_visible_col = 0
+
+    def load_file(self, path, encoding='utf-8', on_error=None):
+        # reading and indexing happen on a worker thread; the text box keeps
+        # its old content until the buffer is ready, or if the read fails
+        return self.bind_future(tasks.submit(load_text_buffer, path, encoding), self.loaded, on_error)
+
+    def map_file(self, path, encoding='utf-8', on_error=None):
+        # read-only view that decodes only the lines on screen; the line
+        # index is built in one streaming pass on a worker thread
+        return self.bind_future(tasks.submit(MappedBuffer, path, encoding), self.loaded, on_error)
+
+    def loaded(self, buffer):
+        self.set_buffer(buffer)
+        if self.multilines:
+            self.vscrollbar.handle.set_pos(0)
+            self.hscrollbar.handle.set_pos(0)
+
+    def set_font(self, name=None, size=None, bold=None, italic=None):
+        super().set_font(name, size, bold, italic)
+        self.widths = None
+
     def text_rect(self):
         return pg.Rect(self.rect().left + self.padding_left, self.rect().top + self.padding_top,
                        self.rect().width - self.padding_left - self.padding_right,
@@ -331,34 +1918,102 @@ class TextBox(Label):
     def get_lines(self):
         return self.text.split("\n")
 
+    def line_count(self):
+        return self.buffer.line_count()
+
+    def line(self, row):
+        return self.buffer.line(row)
+
+    def line_widths(self):
+        if self.widths is None:
+            if self.buffer.read_only:
+                row = self.buffer.longest_row()
+                self.widths = LongestLine(row, self.font.size(self.line(row))[0])
+            else:
+                self.widths = LineWidths(self.font.size(line)[0] for line in self.get_lines())
+        return self.widths
+
+    def line_advances(self, row):
+        line = self.line(row)
+        key = (self.font, line)
+        advances = self.advances_cache.get(key)
+        if advances is None:
+            advances = self.advances_cache[key] = prefix_advances(self.font, line)
+            if len(self.advances_cache) > 64:
+                self.advances_cache.popitem(last=False)
+        else:
+            self.advances_cache.move_to_end(key)
+        return advances
+
+    def lines_changed(self, row, old_count, new_count):
+        if self.widths is not None:
+            self.widths.replace(row, old_count,
+                                [self.font.size(self.line(i))[0] for i in range(row, row + new_count)])
+
+    def insert_text(self, pos, text, record=True):
+        row = self.buffer.row_of(pos)
+        self.buffer.insert(pos, text)
+        if record:
+            self.history.inserted(pos, text)
+        self.lines_changed(row, 1, text.count("\n") + 1)
+
+    def delete_text(self, pos, length, record=True):
+        length = min(length, len(self.buffer) - pos)
+        if length <= 0:
+            return
+        row = self.buffer.row_of(pos)
+        end_row = self.buffer.row_of(pos + length)
+        if record:
+            self.history.deleted(pos, self.buffer.substring(pos, pos + length))
+        self.buffer.delete(pos, length)
+        self.lines_changed(row, end_row - row + 1, 1)
+
+    def undo(self):
+        op = self.history.undo()
+        if op is None:
+            return False
+        kind, pos, text = op
+        if kind == EditLog.INSERT:
+            self.delete_text(pos, len(text), record=False)
+            self.set_caret_pos(pos)
+        else:
+            self.insert_text(pos, text, record=False)
+            self.set_caret_pos(pos + len(text))
+        return True
+
+    def redo(self):
+        op = self.history.redo()
+        if op is None:
+            return False
+        kind, pos, text = op
+        if kind == EditLog.INSERT:
+            self.insert_text(pos, text, record=False)
+            self.set_caret_pos(pos + len(text))
+        else:
+            self.delete_text(pos, len(text), record=False)
+            self.set_caret_pos(pos)
+        return True
+
     def visible_rows(self):
         return (self.height - self.padding_top - self.padding_bottom) // self.font.get_linesize()
 
     def caret_x(self):
-        text = self.text[self.first_visible_col:self.caret_col]
-        x = self.padding_left
-        for (minx, maxx, miny, maxy, advance) in self.font.metrics(text):
-            x += advance
-        return x
+        advances = self.line_advances(self.caret_row)
+        return self.padding_left + advances[self.caret_col] - advances[min(self.first_visible_col, self.caret_col)]
 
     def get_caret_pos(self):
-        lines = self.get_lines()
-        pos = 0
-        for i in range(self.caret_row):
-            pos += len(lines[i]) + 1
-        pos += self.caret_col
-        return pos
-
-    def draw_caret(self):
-        rect = self.form.screen.get_clip()
-        self.form.screen.set_clip(self.rect())
-        pg.draw.line(self.form.screen, pg.Color('black'), (self.rect().left + self.caret_x(),
-                                                           self.rect().top + self.padding_top + self.font.get_linesize() * (
-                                                                       self.caret_row - self.first_visible_row)),
-                     (self.rect().left + self.caret_x(),
-                      self.rect().top + self.padding_top + self.font.get_linesize() * (
-                                  self.caret_row - self.first_visible_row + 1)))
-        self.form.screen.set_clip(rect)
+        return self.buffer.offset(self.caret_row, self.caret_col)
+
+    def draw_caret(self, canvas):
+        clip = canvas.clip
+        canvas.set_clip(self.rect())
+        canvas.line(pg.Color('black'), (self.rect().left + self.caret_x(),
+                                        self.rect().top + self.padding_top + self.font.get_linesize() * (
+                                                    self.caret_row - self.first_visible_row)),
+                    (self.rect().left + self.caret_x(),
+                     self.rect().top + self.padding_top + self.font.get_linesize() * (
+                                 self.caret_row - self.first_visible_row + 1)))
+        canvas.set_clip(clip)
 
     def draw_scrollbars(self):
         '''
@@ -370,107 +2025,98 @@ class TextBox(Label):
                              self.width , self.scrollbar_width))
         '''
         if self.hscrollbar:
-            line_max=0
-            for line in self.get_lines():
-                if line_max<self.font.size(line)[0]:
-                    line_max=self.font.size(line)[0]
-            self.hscrollbar.max=line_max
+            self.hscrollbar.max=self.line_widths().max()
             self.hscrollbar.view_port=self.width
             self.hscrollbar.render()
         if self.vscrollbar:
             self.vscrollbar.view_port=self.visible_rows()
-            self.vscrollbar.max=len(self.get_lines())
+            self.vscrollbar.max=self.line_count()
             self.vscrollbar.render()
 
     def longest_line(self):
-        longest_line = ""
-        max_width = 0
-        for line in self.get_lines():
-            if max_width < self.font.size(line)[0]:
-                max_width = self.font.size(line)[0]
-                longest_line = line
-        return longest_line,max_width
+        widths = self.line_widths()
+        return self.line(widths.longest_row()), widths.max()
+
+    def hscroll_range(self):
+        return self.line_widths().max() - (self.width - self.padding_left - self.padding_right - self.scrollbar_width)
 
     def scrolled(self,scrollbar,pc):
         if scrollbar==self.vscrollbar:
             if pc==0:
                 self.first_visible_row=0
             elif pc==1:
-                self.first_visible_row=len(self.get_lines()) - self.visible_rows()
+                self.first_visible_row=self.line_count() - self.visible_rows()
             else:
-                self.first_visible_row = int((len(self.get_lines()) - self.visible_rows()) * pc)
+                self.first_visible_row = int((self.line_count() - self.visible_rows()) * pc)
         else:
-            if pc==0:
+            if pc==0 or self.hscroll_range() <= 0:
                 self.first_visible_col=0
             else:
-                longest_line,max_width=self.longest_line()
-                i=0
-                while self.font.size(longest_line[:i])[0]/(max_width-(self.width-self.padding_left-self.padding_right-self.scrollbar_width))<pc:
-                    i+=1
-                self.first_visible_col=i
+                advances=self.line_advances(self.line_widths().longest_row())
+                self.first_visible_col=min(bisect_left(advances, pc*self.hscroll_range()), len(advances) - 1)
 
         self.render()
 
 
     def render(self):
         if self.form is not None:
-            pg.draw.rect(self.form.screen, self.background, self.rect())
-            self.form.screen.set_clip(self.text_rect())
-            lines = self.get_lines()
-            for i in range(self.first_visible_row, min(self.first_visible_row + self.visible_rows() + 1, len(lines))):
-                pos = (
-                    self.rect().left + self.padding_left,
-                    self.rect().top + self.padding_top + (i - self.first_visible_row) * self.font.get_linesize())
-                render_text_pos(screen=self.form.screen, font=self.font, text=lines[i][self.first_visible_col:],
-                                color=self.color, pos=pos)
-            self.form.screen.set_clip(None)
-            if self.focused:
-                self.draw_caret()
-            if self.multilines and self.mouse_over:
-                self.draw_scrollbars()
-            pg.draw.rect(self.form.screen, pg.Color("black"), self.rect(), 1)
+            with self.canvas() as canvas:
+                canvas.rect(self.background, self.rect())
+                text_rect = self.text_rect()
+                canvas.set_clip(text_rect)
+                for i in range(self.first_visible_row, min(self.first_visible_row + self.visible_rows() + 1, self.line_count())):
+                    pos = (
+                        self.rect().left + self.padding_left,
+                        self.rect().top + self.padding_top + (i - self.first_visible_row) * self.font.get_linesize())
+                    canvas.text(self.visible_text(i, text_rect.width), self.font, pos, self.color)
+                canvas.set_clip(None)
+                if self.focused:
+                    self.draw_caret(canvas)
+                if self.multilines and self.mouse_over:
+                    self.draw_scrollbars()
+                canvas.rect(pg.Color("black"), self.rect(), 1)
+
+    def visible_text(self, row, width):
+        # long lines are cut after the last column that fits, so only the
+        # visible part is rasterized
+        line = self.line(row)
+        first = self.first_visible_col
+        if len(line) - first <= width:
+            return line[first:]
+        advances = self.line_advances(row)
+        first = min(first, len(advances) - 1)
+        return line[first:bisect_left(advances, advances[first] + width, first) + 1]
 
     def move_caret(self, pos):
-        caret_col = self.first_visible_col
-        left = self.rect().left + self.padding_left
-        for (minx, maxx, miny, maxy, advance) in self.font.metrics(self.text[self.first_visible_col:]):
-            left += advance
-            if left >= pos[0]:
-                break
-            caret_col += 1
         caret_row = (pos[1] - self.rect().top - self.padding_top) // self.font.get_linesize() + self.first_visible_row
+        caret_row = min(max(caret_row, 0), self.line_count() - 1)
+        advances = self.line_advances(caret_row)
+        first_visible_col = min(self.first_visible_col, len(advances) - 1)
+        x = pos[0] - self.rect().left - self.padding_left + advances[first_visible_col]
+        caret_col = max(bisect_left(advances, x, first_visible_col + 1) - 1, first_visible_col)
 
         self.set_caret(caret_row, caret_col)
 
     def set_caret_pos(self, pos):
-        pos = min(max(pos, 0), len(self.text) - 1)
-        row, col, idx = 0, 0, 0
-        text = ""
-        while True:
-            if len(text + self.get_lines()[row]) < pos:
-                text += self.get_lines()[row]+"\n"
-                row += 1
-                continue
-            else:
-                col = pos - len(text)
-                break
+        row, col = self.buffer.position(pos)
         self.set_caret(row, col)
 
     def set_caret(self, caret_row, caret_col):
-        self.caret_row = min(max(caret_row, 0), len(self.get_lines()) - 1)
-        self.caret_col = min(max(caret_col, 0), len(self.get_lines()[self.caret_row]))
-        while self.caret_x() > self.width - self.padding_right:
-            self.first_visible_col += 1
-        while self.first_visible_col > 0 and self.caret_col - 1 < self.first_visible_col:
-            self.first_visible_col -= 1
-        while self.first_visible_row > self.caret_row:
-            self.first_visible_row -= 1
-        while self.first_visible_row + self.visible_rows() - 1 < self.caret_row:
-            self.first_visible_row += 1
+        self.caret_row = min(max(caret_row, 0), self.line_count() - 1)
+        self.caret_col = min(max(caret_col, 0), self.buffer.line_length(self.caret_row))
+        advances = self.line_advances(self.caret_row)
+        self.first_visible_col = max(self.first_visible_col, bisect_left(
+            advances, advances[self.caret_col] + self.padding_left + self.padding_right - self.width))
+        self.first_visible_col = max(min(self.first_visible_col, self.caret_col - 1), 0)
+        self.first_visible_row = min(self.first_visible_row, self.caret_row)
+        self.first_visible_row = max(self.first_visible_row, self.caret_row - self.visible_rows() + 1)
         if self.multilines:
-            self.vscrollbar.set_pos(self.first_visible_row/(len(self.get_lines())-self.visible_rows()))
-            longest_line,max_width=self.longest_line()
-            self.hscrollbar.set_pos(self.font.size(longest_line[:self.first_visible_col])[0]/(max_width-(self.width-self.padding_left-self.padding_right-self.scrollbar_width)))
+            self.vscrollbar.set_pos(self.first_visible_row/max(self.line_count()-self.visible_rows(), 1))
+            if self.hscroll_range() > 0:
+                advances = self.line_advances(self.line_widths().longest_row())
+                self.hscrollbar.set_pos(min(advances[min(self.first_visible_col, len(advances) - 1)]/self.hscroll_range(), 1))
+            else:
+                self.hscrollbar.set_pos(0)
         self.render()
 
     def mouse_down(self, event):
@@ -479,6 +2125,7 @@ class TextBox(Label):
                 self.move_caret(event.pos)
             elif not self.vscrollbar.rect().collidepoint(event.pos) and not self.hscrollbar.rect().collidepoint(event.pos):
                 self.move_caret(event.pos)
+            self.history.seal()
         super().mouse_down(event)
         self.render()
 
@@ -493,168 +2140,1000 @@ class TextBox(Label):
     def on_key_down(self, event):
         return True
 
+    def accept_key(self, event):
+        # on_key_down sees every keystroke even when a burst was merged into
+        # one event; the accepted ones are merged again
+        sources = getattr(event, 'events', None)
+        if sources is None:
+            return event if self.on_key_down(event) else None
+        accepted = [source for source in sources if self.on_key_down(source)]
+        if len(accepted) == len(sources):
+            return event
+        return coalesce_events(accepted)[0] if accepted else None
+
     def key_down(self, event):
-        if not self.on_key_down(event):
-            return
-        if event.key == pg.K_BACKSPACE and self.get_caret_pos() > 0:
-            pre_pos=self.get_caret_pos()
-            self.text = self.text[0:self.get_caret_pos() - 1] + self.text[self.get_caret_pos():]
-            self.set_caret_pos(pre_pos - 1)
-        elif event.key == pg.K_DELETE and self.get_caret_pos() < len(self.text):
-            self.text = self.text[0:self.get_caret_pos()] + self.text[self.get_caret_pos() + 1:]
+        event = self.accept_key(event)
+        if event is None:
+            return
+        if self.buffer.read_only and (event.key in (pg.K_BACKSPACE, pg.K_DELETE, pg.K_RETURN) or is_text_event(event)):
+            return
+        if getattr(event, 'mod', 0) & pg.KMOD_CTRL and event.key in (pg.K_z, pg.K_y):
+            step = self.redo if event.key == pg.K_y or getattr(event, 'mod', 0) & pg.KMOD_SHIFT else self.undo
+            for _ in range(getattr(event, 'count', 1)):
+                step()
+            return
+        pos = self.get_caret_pos()
+        count = getattr(event, 'count', 1)
+        if event.key == pg.K_BACKSPACE and pos > 0:
+            count = min(count, pos)
+            self.delete_text(pos - count, count)
+            self.set_caret_pos(pos - count)
+        elif event.key == pg.K_DELETE and pos < len(self.buffer):
+            self.delete_text(pos, count)
         elif event.key == pg.K_LEFT and self.caret_col > 0:
-            self.set_caret(self.caret_row, self.caret_col - 1)
-        elif event.key == pg.K_RIGHT and self.get_caret_pos() < len(self.text):
-            self.set_caret(self.caret_row, self.caret_col + 1)
+            self.set_caret(self.caret_row, self.caret_col - count)
+        elif event.key == pg.K_RIGHT and pos < len(self.buffer):
+            self.set_caret(self.caret_row, self.caret_col + count)
         elif event.key == pg.K_HOME:
             self.set_caret(self.caret_row, 0)
         elif event.key == pg.K_END:
-            self.set_caret(self.caret_row, len(self.get_lines()[self.caret_row]))
+            self.set_caret(self.caret_row, self.buffer.line_length(self.caret_row))
         elif event.key == pg.K_UP:
-            self.set_caret(self.caret_row - 1, self.caret_col)
+            self.set_caret(self.caret_row - count, self.caret_col)
         elif event.key == pg.K_DOWN:
-            self.set_caret(self.caret_row + 1, self.caret_col)
+            self.set_caret(self.caret_row + count, self.caret_col)
         elif event.key == pg.K_PAGEUP:
-            self.set_caret(self.caret_row - self.visible_rows(), self.caret_col)
+            self.set_caret(self.caret_row - self.visible_rows() * count, self.caret_col)
         elif event.key == pg.K_PAGEDOWN:
-            self.set_caret(self.caret_row + self.visible_rows(), self.caret_col)
+            self.set_caret(self.caret_row + self.visible_rows() * count, self.caret_col)
         elif event.key == pg.K_RETURN and self.multilines:
-            self.text = self.text[0:self.get_caret_pos()] + "\n" + self.text[self.get_caret_pos():]
-            self.set_caret(self.caret_row + 1, 0)
-        elif event.unicode and 32 <= ord(event.unicode) <= 126:
-            self.text = self.text[0:self.get_caret_pos()] + event.unicode + self.text[self.get_caret_pos():]
-            self.set_caret(self.caret_row, self.caret_col + 1)
+            self.insert_text(pos, "\n" * count)
+            self.set_caret(self.caret_row + count, 0)
+        elif is_text_event(event):
+            self.insert_text(pos, event.unicode)
+            self.set_caret(self.caret_row, self.caret_col + len(event.unicode))
         self.render()
 
 
 class CheckBox(Control):
+    __slots__ = ('checked',)
+    default_size = (20, 20)
+
     def __init__(self, form=None, left=0, top=0):
         super().__init__(form=form, left=left, top=top)
         self.checked = False
-        self.width = 20
-        self.height = 20
+        self.width, self.height = self.default_size
 
     def mouse_click(self, event):
         self.checked = not self.checked
         self.render()
 
     def render(self):
-        pg.draw.rect(self.form.screen, pg.Color('white'), self.rect(), 0)
-        pg.draw.rect(self.form.screen, pg.Color('black'), self.rect(), 1)
-        if self.checked:
-            pg.draw.line(self.form.screen, pg.Color('black'), (self.rect().left, self.rect().top),
-                         (self.rect().left + self.rect().width - 1, self.rect().top + self.rect().height - 1), 1)
-            pg.draw.line(self.form.screen, pg.Color('black'),
-                         (self.rect().left, self.rect().top + self.rect().height - 1),
-                         (self.rect().left + self.rect().width - 1, self.rect().top), 1)
+        with self.canvas() as canvas:
+            canvas.rect(pg.Color('white'), self.rect(), 0)
+            canvas.rect(pg.Color('black'), self.rect(), 1)
+            if self.checked:
+                canvas.line(pg.Color('black'), (self.rect().left, self.rect().top),
+                            (self.rect().left + self.rect().width - 1, self.rect().top + self.rect().height - 1), 1)
+                canvas.line(pg.Color('black'),
+                            (self.rect().left, self.rect().top + self.rect().height - 1),
+                            (self.rect().left + self.rect().width - 1, self.rect().top), 1)
+
+
+class RadioGroup:
+    __slots__ = ('members', '_checked')
+
+    def __init__(self):
+        self.members = weakref.WeakSet()
+        self._checked = None
+
+    @property
+    def checked(self):
+        return self._checked() if self._checked is not None else None
+
+    @checked.setter
+    def checked(self, button):
+        self._checked = weakref.ref(button) if button is not None else None
+
+    def value(self):
+        button = self.checked
+        return button.value if button is not None else None
+
+
+class RadioGroups:
+    # group_id -> RadioGroup; each form has its own registry so equal ids on
+    # different forms stay independent
+    def __init__(self):
+        self.groups = {}
+
+    def join(self, button):
+        group = self.groups.get(button.group_id)
+        if group is None:
+            group = self.groups[button.group_id] = RadioGroup()
+        group.members.add(button)
+        return group
+
+    def group(self, group_id):
+        return self.groups.get(group_id)
+
+    def selected(self, group_id):
+        group = self.groups.get(group_id)
+        return group.checked if group is not None else None
+
+    def value(self, group_id):
+        group = self.groups.get(group_id)
+        return group.value() if group is not None else None
+
+
+radio_groups = RadioGroups()
 
 
 class RadioButton(Control):
-    def __init__(self, form=None, left=0, top=0, group_id='default'):
+    __slots__ = ('_checked', '_group', 'group_id', 'value')
+    default_size = (20, 20)
+
+    def __init__(self, form=None, left=0, top=0, group_id='default', value=None):
         super().__init__(form=form, left=left, top=top)
-        self.checked = False
-        self.width = 20
-        self.height = 20
+        self._checked = False
+        self._group = None
+        self.width, self.height = self.default_size
         self.group_id = group_id
+        self.value = value
+        if form is not None:
+            self.group()
+
+    def group(self):
+        # containers built before they were added to a form leave form unset
+        # on their children, so fall back to the top of the parent chain
+        form = self.form
+        if form is None:
+            form = self.parent
+            while form is not None and form.parent is not None:
+                form = form.parent
+        registry = form.radio_groups if isinstance(form, PyForm) else radio_groups
+        group = registry.join(self)
+        if group is not self._group:
+            self.move_to(group)
+        return group
+
+    def move_to(self, group):
+        # a radio checked before its container reached a form takes its
+        # state from the module registry into the form's group
+        old, self._group = self._group, group
+        if old is not None:
+            old.members.discard(self)
+            if old.checked is self:
+                old.checked = None
+        if self._checked:
+            previous = group.checked
+            if previous is not None and previous is not self:
+                previous._checked = False
+                previous.render()
+            group.checked = self
+
+    def attached(self):
+        super().attached()
+        self.group()
+
+    @property
+    def checked(self):
+        return self._checked
+
+    @checked.setter
+    def checked(self, checked):
+        group = self.group()
+        if checked:
+            previous = group.checked
+            if previous is not None and previous is not self:
+                previous._checked = False
+            group.checked = self
+        elif group.checked is self:
+            group.checked = None
+        self._checked = checked
 
     def mouse_click(self, event):
+        previous = self.group().checked
         self.checked = True
-        for control in self.form.controls:
-            if control != self and isinstance(control,
-                                              RadioButton) and control.checked and control.group_id == self.group_id:
-                control.checked = False
-                control.render()
+        if previous is not None and previous is not self:
+            previous.render()
         self.render()
 
     def render(self):
-        pg.gfxdraw.filled_circle(self.form.screen, self.rect().left + self.width // 2,
-                                 self.rect().top + self.height // 2, 10, pg.Color('white'))
-        pg.gfxdraw.circle(self.form.screen, self.rect().left + self.width // 2,
-                          self.rect().top + self.height // 2, 10, pg.Color('black'))
-        if self.checked:
-            pg.gfxdraw.circle(self.form.screen, self.rect().left + self.width // 2,
-                              self.rect().top + self.height // 2, 5, pg.Color('black'))
-            pg.gfxdraw.filled_circle(self.form.screen, self.rect().left + self.width // 2,
-                                     self.rect().top + self.height // 2, 5, pg.Color('black'))
+        center = (self.rect().left + self.width // 2, self.rect().top + self.height // 2)
+        with self.canvas() as canvas:
+            canvas.filled_circle(pg.Color('white'), center, 10)
+            canvas.circle(pg.Color('black'), center, 10)
+            if self.checked:
+                canvas.circle(pg.Color('black'), center, 5)
+                canvas.filled_circle(pg.Color('black'), center, 5)
+
+
+class ListRow(Control):
+    __slots__ = ('index', 'value')
+
+    def __init__(self):
+        super().__init__()
+        self.index = None
+        self.value = None
+
+    def bind(self, index, value):
+        self.index = index
+        self.value = value
+
+    def mouse_click(self, event):
+        if self.index is not None:
+            self.parent.select(self.index)
+
+    def colors(self):
+        if self.index is not None and self.index == self.parent.selected:
+            return pg.Color('white'), pg.Color('blue')
+        return self.parent.color, self.parent.background
+
+    def render(self):
+        color, background = self.colors()
+        rect = self.rect()
+        with self.canvas() as canvas:
+            canvas.set_clip(self.parent.rows_rect())
+            canvas.rect(background, rect)
+            if self.index is not None:
+                canvas.text(self.parent.format(self.value), self.parent.font,
+                            (rect.left + self.parent.padding_left, rect.top), color)
+
+
+class ListBox(Control):
+    __slots__ = ('padding_left', 'scrollbar_width', 'first_visible_row', 'selected', 'on_select', 'rows', 'layout_size',
+                 'vscrollbar', 'items', 'count')
+    row_class = ListRow
+
+    def __init__(self, form=None, left=0, top=0, width=0, height=0, items=(), count=None):
+        super().__init__(form=form, left=left, top=top, width=width, height=height)
+        self.color = pg.Color('black')
+        self.background = pg.Color('white')
+        self.padding_left = 2
+        self.scrollbar_width = 10
+        self.first_visible_row = 0
+        self.selected = None
+        self.on_select = None
+        self.rows = []
+        self.layout_size = None
+        self.vscrollbar = ScrollBar(form=form, parent=self, width=self.scrollbar_width, orientation=1)
+        self.add_control(self.vscrollbar)
+        self.set_items(items, count)
+
+    def set_items(self, items, count=None):
+        # items is a sequence, or a callable returning the item at an index
+        # with the number of items passed as count
+        self.items = items
+        self.count = count
+        self.first_visible_row = 0
+        self.selected = None
+        self.bind_rows()
+
+    def item_count(self):
+        return self.count if self.count is not None else len(self.items)
+
+    def item(self, index):
+        return self.items(index) if callable(self.items) else self.items[index]
+
+    def format(self, value):
+        return str(value)
+
+    def rows_top(self):
+        return 1
+
+    def rows_rect(self):
+        rect = self.rect()
+        top = self.rows_top()
+        return pg.Rect(rect.left + 1, rect.top + top, self.width - self.scrollbar_width - 2, self.height - top - 1)
+
+    def row_height(self):
+        return self.font.get_linesize()
+
+    def visible_rows(self):
+        return max(self.rows_rect().height // self.row_height(), 1)
+
+    def layout(self):
+        # rows are a fixed pool sized to the viewport; scrolling rebinds them
+        # to other items instead of creating a widget per item
+        row_height = self.row_height()
+        if self.layout_size == (self.width, self.height, row_height):
+            return False
+        self.layout_size = (self.width, self.height, row_height)
+        area = self.rows_rect()
+        top = self.rows_top()
+        count = max(-(-area.height // row_height), 0)
+        while len(self.rows) > count:
+            self.remove_control(self.rows.pop())
+        while len(self.rows) < count:
+            row = self.row_class()
+            self.rows.append(row)
+            self.add_control(row)
+        for i, row in enumerate(self.rows):
+            row.left, row.top = 1, top + i * row_height
+            row.width, row.height = area.width, row_height
+        self.vscrollbar.left, self.vscrollbar.top = self.width - self.scrollbar_width - 1, top
+        self.vscrollbar.length = self.vscrollbar.height = max(area.height, 0)
+        self.bind_rows()
+        return True
+
+    def bind_rows(self):
+        count = self.item_count()
+        for i, row in enumerate(self.rows):
+            index = self.first_visible_row + i
+            if index < count:
+                row.bind(index, self.item(index))
+            else:
+                row.bind(None, None)
+
+    def refresh(self):
+        self.first_visible_row = min(self.first_visible_row, self.max_first_row())
+        self.bind_rows()
+        self.render()
+
+    def max_first_row(self):
+        return max(self.item_count() - self.visible_rows(), 0)
+
+    def scroll_to(self, row):
+        row = min(max(row, 0), self.max_first_row())
+        if row != self.first_visible_row:
+            self.first_visible_row = row
+            self.bind_rows()
+        self.render()
+
+    def scrolled(self, scrollbar, pc):
+        self.first_visible_row = int(self.max_first_row() * pc)
+        self.bind_rows()
+        self.render()
+
+    def select(self, index):
+        if self.item_count() == 0:
+            return
+        index = min(max(index, 0), self.item_count() - 1)
+        self.selected = index
+        if index < self.first_visible_row:
+            self.scroll_to(index)
+        elif index >= self.first_visible_row + self.visible_rows():
+            self.scroll_to(index - self.visible_rows() + 1)
+        else:
+            self.render()
+        if callable(self.on_select):
+            call_handler(self.on_select, index, self.item(index))
+
+    def selected_item(self):
+        return None if self.selected is None else self.item(self.selected)
+
+    def key_down(self, event):
+        if not self.focused:
+            return
+        current = self.selected if self.selected is not None else self.first_visible_row - 1
+        count = getattr(event, 'count', 1)
+        if event.key == pg.K_UP:
+            self.select(current - count)
+        elif event.key == pg.K_DOWN:
+            self.select(current + count)
+        elif event.key == pg.K_PAGEUP:
+            self.select(current - self.visible_rows() * count)
+        elif event.key == pg.K_PAGEDOWN:
+            self.select(current + self.visible_rows() * count)
+        elif event.key == pg.K_HOME:
+            self.select(0)
+        elif event.key == pg.K_END:
+            self.select(self.item_count() - 1)
+
+    def draw_scrollbar(self, scrollbar, max, view_port, pc):
+        scrollbar.max = max
+        scrollbar.view_port = view_port
+        if not scrollbar.handle_size():
+            return
+        if not scrollbar.handle.dragging:
+            # the handle follows the view unless the user is dragging it
+            scrollbar.handle.max = scrollbar.length - scrollbar.handle_size()
+            scrollbar.handle.set_pos(pc)
+        scrollbar.render()
+
+    def draw_scrollbars(self):
+        self.draw_scrollbar(self.vscrollbar, self.item_count(), self.visible_rows(),
+                            self.first_visible_row / max(self.max_first_row(), 1))
+
+    def draw_header(self, canvas):
+        pass
+
+    def render(self):
+        if self.form is None:
+            return
+        self.layout()
+        with self.canvas() as canvas:
+            canvas.rect(self.background, self.rect())
+            self.draw_header(canvas)
+            for row in self.rows:
+                row.render()
+            self.draw_scrollbars()
+            canvas.rect(pg.Color('black'), self.rect(), 1)
+
+
+class GridRow(ListRow):
+    __slots__ = ()
+
+    def render(self):
+        color, background = self.colors()
+        rect = self.rect()
+        grid = self.parent
+        area = grid.rows_rect()
+        with self.canvas() as canvas:
+            canvas.set_clip(area)
+            canvas.rect(background, rect)
+            if self.index is None:
+                return
+            for i, (left, width) in enumerate(grid.column_spans()):
+                cell = pg.Rect(left, rect.top, width, rect.height).clip(area)
+                if cell.width:
+                    canvas.set_clip(cell)
+                    canvas.text(grid.format_cell(self.value, i), grid.font, (left + grid.padding_left, rect.top), color)
+                    canvas.line(pg.Color('lightgray'), (left + width - 1, rect.top), (left + width - 1, rect.bottom - 1))
+
+
+class DataGrid(ListBox):
+    __slots__ = ('columns', 'first_visible_x', 'header_color', 'hscrollbar')
+    row_class = GridRow
+
+    def __init__(self, form=None, left=0, top=0, width=0, height=0, columns=(), items=(), count=None):
+        # columns are (title, width) or (title, width, key) tuples; a cell shows
+        # row[key], and key defaults to the column position
+        self.columns = [tuple(column) if len(column) == 3 else (column[0], column[1], i)
+                        for i, column in enumerate(columns)]
+        self.first_visible_x = 0
+        super().__init__(form=form, left=left, top=top, width=width, height=height, items=items, count=count)
+        self.header_color = pg.Color('lightgray')
+        self.hscrollbar = ScrollBar(form=form, parent=self, width=self.scrollbar_width, orientation=0)
+        self.add_control(self.hscrollbar)
+
+    def format_cell(self, value, column):
+        return self.format(value[self.columns[column][2]])
+
+    def columns_width(self):
+        return sum(column[1] for column in self.columns)
+
+    def column_spans(self):
+        left = self.rect().left + 1 - self.first_visible_x
+        for title, width, key in self.columns:
+            yield left, width
+            left += width
+
+    def rows_top(self):
+        return 1 + self.row_height()
+
+    def rows_rect(self):
+        rect = super().rows_rect()
+        rect.height -= self.scrollbar_width
+        return rect
+
+    def hscroll_range(self):
+        return max(self.columns_width() - self.rows_rect().width, 0)
+
+    def layout(self):
+        if not super().layout():
+            return False
+        self.hscrollbar.left, self.hscrollbar.top = 1, self.height - self.scrollbar_width - 1
+        self.hscrollbar.length = self.hscrollbar.width = self.width - self.scrollbar_width - 2
+        return True
+
+    def scrolled(self, scrollbar, pc):
+        if scrollbar == self.hscrollbar:
+            self.first_visible_x = int(self.hscroll_range() * pc)
+            self.render()
+        else:
+            super().scrolled(scrollbar, pc)
+
+    def draw_header(self, canvas):
+        header = pg.Rect(self.rect().left + 1, self.rect().top + 1, self.width - 2, self.row_height())
+        canvas.rect(self.header_color, header)
+        for (left, width), (title, _, _) in zip(self.column_spans(), self.columns):
+            cell = pg.Rect(left, header.top, width, header.height).clip(header)
+            if cell.width:
+                canvas.set_clip(cell)
+                canvas.text(title, self.font, (left + self.padding_left, header.top), self.color)
+                canvas.line(pg.Color('black'), (left + width - 1, header.top), (left + width - 1, header.bottom - 1))
+        canvas.set_clip(None)
+
+    def draw_scrollbars(self):
+        super().draw_scrollbars()
+        self.draw_scrollbar(self.hscrollbar, self.columns_width(), self.rows_rect().width,
+                            self.first_visible_x / max(self.hscroll_range(), 1))
+
+
+LAYOUT_VERSION = 2
+
+
+def control_class(name):
+    cls = globals().get(name)
+    if isinstance(cls, type) and issubclass(cls, Control):
+        return cls
+    # subclasses defined outside this module are found by name as well
+    pending = [Control]
+    while pending:
+        cls = pending.pop()
+        if cls.__name__ == name:
+            return cls
+        pending.extend(cls.__subclasses__())
+    raise ValueError("unknown control type %r" % name)
+
+
+@functools.lru_cache(maxsize=None)
+def control_params(cls):
+    # keyword arguments cls() accepts, following **args up to the base classes
+    params = set()
+    for klass in cls.__mro__:
+        if '__init__' not in vars(klass):
+            continue
+        parameters = inspect.signature(klass.__init__).parameters.values()
+        params.update(p.name for p in parameters if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+        if not any(p.kind == p.VAR_KEYWORD for p in parameters):
+            break
+    params.discard('self')
+    return frozenset(params)
+
+
+def settable(cls, name):
+    # slots and properties with a setter; methods and read-only properties
+    # cannot be assigned on slotted instances
+    attribute = inspect.getattr_static(cls, name, None)
+    if isinstance(attribute, property):
+        return attribute.fset is not None
+    if inspect.ismemberdescriptor(attribute):
+        return True
+    return attribute is not None and cls.__dictoffset__ != 0 and not callable(attribute)
+
+
+def freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return {key: freeze(item) for key, item in value.items()}
+    return value
+
+
+def compile_control(spec):
+    # (type, name, constructor arguments, attributes, bounds, children)
+    spec = dict(spec)
+    if 'type' not in spec:
+        raise ValueError("control description without a type: %r" % spec)
+    type_name = spec.pop('type')
+    cls = control_class(type_name)
+    params = control_params(cls)
+    if 'form' not in params:
+        raise ValueError("%s cannot be placed on a form" % type_name)
+    name = spec.pop('name', None)
+    children = tuple(compile_control(child) for child in spec.pop('controls', ()))
+    kwargs, attrs = {}, {}
+    for key, value in spec.items():
+        if key in params and key not in ('form', 'parent'):
+            kwargs[key] = freeze(value)
+        elif key == 'font' or settable(cls, key):
+            attrs[key] = freeze(value)
+        else:
+            raise ValueError("%s has no attribute %r" % (type_name, key))
+    width, height = cls.default_size
+    bounds = (spec.get('left', 0), spec.get('top', 0), spec.get('width', width), spec.get('height', height))
+    return (type_name, name, kwargs, attrs, bounds, children)
+
+
+def compile_form(spec):
+    # checks a dict description of a form and turns it into the layout that
+    # PyForm.load builds from; the result only holds plain data, so it pickles
+    spec = dict(spec)
+    children = tuple(compile_control(child) for child in spec.pop('controls', ()))
+    unknown = set(spec) - {'title', 'left', 'top', 'width', 'height'}
+    if unknown:
+        raise ValueError("unknown form attributes %s" % ", ".join(sorted(unknown)))
+    return (spec, children)
+
+
+def load_layout(path, cache_path=None):
+    # a JSON description is compiled once and kept pickled next to it; the
+    # cache is used for as long as the JSON file is unchanged
+    cache_path = cache_path if cache_path is not None else path + '.layout'
+    stat = os.stat(path)
+    stamp = (LAYOUT_VERSION, stat.st_mtime_ns, stat.st_size)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_stamp, layout = pickle.load(f)
+        if cached_stamp == stamp:
+            return layout
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        pass
+    with open(path, encoding='utf-8') as f:
+        layout = compile_form(json.load(f))
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump((stamp, layout), f, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+    return layout
+
+
+class LazyControl(Control):
+    # Stands in for a control of a loaded layout. It has the control's
+    # geometry, so hit-testing works, and builds the real control in its place
+    # the first time it is drawn or hit.
+    __slots__ = ('spec', 'control')
+
+    def __init__(self, spec):
+        left, top, width, height = spec[4]
+        super().__init__(left=left, top=top, width=width, height=height)
+        self.spec = spec
+        self.control = None
+
+    @staticmethod
+    def place(parent, nodes, form):
+        for node in nodes:
+            placeholder = LazyControl(node)
+            parent.add_control(placeholder)
+            if node[1] is not None:
+                form.names[node[1]] = placeholder
+
+    def build(self):
+        if self.control is not None:
+            return self.control
+        type_name, name, kwargs, attrs, bounds, children = self.spec
+        form = self.form
+        control = self.control = control_class(type_name)(form=form, **kwargs)
+        for key, value in attrs.items():
+            if key == 'font':
+                control.set_font(**value)
+                continue
+            if key.startswith('on_') and isinstance(value, str):
+                if value not in form.handlers:
+                    raise ValueError("no handler named %r for %s" % (value, type_name))
+                value = form.handlers[value]
+            setattr(control, key, value)
+        self.parent.replace_control(self, control)
+        LazyControl.place(control, children, form)
+        if name is not None:
+            form.names[name] = control
+        return control
+
+    def render(self):
+        self.build().render()
+
+    def handle_event(self, event):
+        self.build().handle_event(event)
+
+
+class WindowManager:
+    managers = {}
+
+    def __init__(self, display, background=None):
+        self.display = display
+        self.background = background
+        self.forms = []
+        self.overlays = []
+        self.focus = None
+        self.hover = None
+        self.damaged = DirtyRects()
+
+    @classmethod
+    def for_display(cls, display):
+        manager = cls.managers.get(display)
+        if manager is None:
+            manager = cls.managers[display] = cls(display)
+        return manager
+
+    def set_background(self, background):
+        self.background = background
+        self.damage(self.display.get_rect())
+
+    def damage(self, rect):
+        self.damaged.add(rect)
+
+    def add_overlay(self, display_list):
+        # display lists drawn straight onto the display above every form;
+        # their damage is composed here instead of being flushed on its own
+        if self.background is None:
+            self.background = self.display.copy()
+        self.overlays.append(display_list)
+
+    def form_damaged(self, form, rect):
+        if form in self.forms:
+            self.damage(rect.move(form.left, form.top))
+
+    def open(self, form):
+        if self.background is None:
+            self.background = self.display.copy()
+        if form in self.forms:
+            self.forms.remove(form)
+        self.forms.append(form)
+        self.focus = form
+        self.damage(form.window_rect())
+
+    def close(self, form):
+        if form in self.forms:
+            self.forms.remove(form)
+            self.damage(form.window_rect())
+        if self.focus is form:
+            self.focus = self.forms[-1] if self.forms else None
+        if self.hover is form:
+            self.hover = None
+
+    def raise_form(self, form):
+        if form in self.forms and self.forms[-1] is not form:
+            self.forms.remove(form)
+            self.forms.append(form)
+            self.damage(form.window_rect())
+        self.focus = form
+
+    def moved(self, form, old_rect):
+        if form in self.forms:
+            self.damage(old_rect)
+            self.damage(form.window_rect())
+
+    def form_at(self, pos):
+        for form in reversed(self.forms):
+            if form.window_rect().collidepoint(pos):
+                return form
+        return None
+
+    def compose(self):
+        for form in self.forms:
+            form.display_list.flush()
+        for overlay in self.overlays:
+            self.damaged.rects.extend(overlay.damaged.rects)
+            overlay.damaged.clear()
+        if not self.damaged.rects:
+            return
+        bounds = self.display.get_rect()
+        for rect in self.damaged.merged():
+            rect = rect.clip(bounds)
+            if not rect.width or not rect.height:
+                continue
+            if self.background is not None:
+                self.display.blit(self.background, rect, rect)
+            for form in self.forms:
+                area = rect.clip(form.window_rect())
+                if area.width and area.height:
+                    self.display.blit(form.screen, area, area.move(-form.left, -form.top))
+            for overlay in self.overlays:
+                overlay.replay(rect)
+            dirty_rects.add(rect)
+        self.damaged.clear()
+
+    def handle_event(self, event):
+        targets = []
+        if hasattr(event, 'pos'):
+            form = self.form_at(event.pos)
+            if event.type == pg.MOUSEBUTTONDOWN and form is not None:
+                self.raise_form(form)
+            for target in (self.hover, form, self.focus):
+                if target is not None and target not in targets:
+                    targets.append(target)
+            self.hover = form
+        elif self.focus is not None:
+            targets.append(self.focus)
+        for form in targets:
+            form.handle_event(event)
+        dirty_rects.update()
 
 
 class PyForm(Control):
+    __slots__ = ('display', 'manager', 'screen', 'display_list', 'visible', 'dragging', 'dragging_pos', 'title',
+                 'show_profile', 'radio_groups', 'names', 'handlers')
     title_height = 20
     title_color = pg.Color('lightgray')
 
-    def __init__(self, screen, left=0, top=0, width=0, height=0, title=""):
+    def __init__(self, screen, left=0, top=0, width=0, height=0, title="", manager=None):
+        self.display = screen
+        self.manager = manager if manager is not None else WindowManager.for_display(screen)
+        self.radio_groups = RadioGroups()
         super().__init__(form=None, left=left, top=top, width=width, height=height)
-        self.screen = screen
-        self.covered_screen = None
+        self.screen = pg.Surface((max(width, 1), max(height, 1)), 0, screen)
+        self.display_list = DisplayList(self.screen, self.invalidate)
         self.visible = False
         self.dragging = False
         self.dragging_pos = None
         self.title = title
-        self.set_font('Courier', 18)
+        self.show_profile = False
+        self.names = {}
+        self.handlers = {}
+
+    @classmethod
+    def load(cls, screen, spec, handlers=None, manager=None):
+        # spec is a dict, the path of a JSON file or a layout from compile_form;
+        # controls stay placeholders until they are first drawn or hit
+        if isinstance(spec, (str, os.PathLike)):
+            spec = load_layout(os.fspath(spec))
+        elif isinstance(spec, dict):
+            spec = compile_form(spec)
+        form_args, children = spec
+        form = cls(screen, manager=manager, **form_args)
+        form.handlers = dict(handlers or {})
+        LazyControl.place(form, children, form)
+        return form
+
+    def find(self, name):
+        control = self.names.get(name)
+        if isinstance(control, LazyControl):
+            control = control.build()
+        return control
 
     def add_control(self, control):
-        self.controls.append(control)
+        if self._controls is None:
+            self._controls = []
+        self._controls.append(control)
         control.form = self
+        if control.parent is None:
+            control.parent = self
+        control.geometry_changed()
+        if self._index is not None:
+            self._index.add(control)
+        control.attached()
+
+    @property
+    def left(self):
+        return self._left
+
+    @left.setter
+    def left(self, left):
+        if left != self._left:
+            old_rect = self.window_rect()
+            self._left = left
+            self.manager.moved(self, old_rect)
+
+    @property
+    def top(self):
+        return self._top
+
+    @top.setter
+    def top(self, top):
+        if top != self._top:
+            old_rect = self.window_rect()
+            self._top = top
+            self.manager.moved(self, old_rect)
+
+    @property
+    def width(self):
+        return self._width
+
+    @width.setter
+    def width(self, width):
+        if width != self._width:
+            old_rect = self.window_rect()
+            self._width = width
+            self.moved()
+            self.manager.moved(self, old_rect)
+
+    @property
+    def height(self):
+        return self._height
+
+    @height.setter
+    def height(self, height):
+        if height != self._height:
+            old_rect = self.window_rect()
+            self._height = height
+            self.moved()
+            self.manager.moved(self, old_rect)
+
+    def rect(self):
+        # controls draw on the form's own surface, so the form is their origin
+        if self._rect is None:
+            self._rect = pg.Rect(0, 0, self._width, self._height)
+        return self._rect
+
+    def window_rect(self):
+        return pg.Rect(self._left, self._top, self._width, self._height)
+
+    def client_origin(self):
+        return 0, self.title_height
+
+    def invalidate(self, rect=None):
+        self.manager.form_damaged(self, self.rect() if rect is None else rect)
+
+    def get_display_list(self):
+        return self.display_list
 
     def x_rect(self):
-        return pg.Rect(self.left + self.width - self.title_height, self.top, self.title_height, self.title_height)
+        return pg.Rect(self.width - self.title_height, 0, self.title_height, self.title_height)
 
     def handle_rect(self):
-        return pg.Rect(self.left, self.top, self.width - self.title_height, self.title_height)
+        return pg.Rect(0, 0, self.width - self.title_height, self.title_height)
 
     def title_rect(self):
-        return pg.Rect(self.left, self.top, self.width, self.title_height)
+        return pg.Rect(0, 0, self.width, self.title_height)
 
     def draw_x(self, color=pg.Color('black'), bgcolor=None):
         if bgcolor is None:
             bgcolor = self.title_color
-        pg.draw.rect(self.screen, bgcolor, self.x_rect())
-        pg.draw.line(self.screen, color, (self.x_rect().left + 4, self.x_rect().top + 4),
-                     (self.x_rect().left + self.x_rect().width - 4, self.x_rect().top + self.x_rect().height - 4), 1)
-        pg.draw.line(self.screen, color, (self.x_rect().left + 4, self.x_rect().top + self.x_rect().height - 4),
-                     (self.x_rect().left + self.x_rect().width - 4, self.x_rect().top + 4), 1)
+        x_rect = self.x_rect()
+        with self.canvas((self, 'x')) as canvas:
+            canvas.rect(bgcolor, x_rect)
+            canvas.line(color, (x_rect.left + 4, x_rect.top + 4),
+                        (x_rect.left + x_rect.width - 4, x_rect.top + x_rect.height - 4), 1)
+            canvas.line(color, (x_rect.left + 4, x_rect.top + x_rect.height - 4),
+                        (x_rect.left + x_rect.width - 4, x_rect.top + 4), 1)
 
-    def draw_title(self):
-        pg.draw.rect(self.screen, self.title_color, self.title_rect(), 0)
-        render_text_rect(self.screen, self.title, self.font, self.title_rect(), pg.Color('black'))
+    def draw_title(self, canvas):
+        canvas.rect(self.title_color, self.title_rect(), 0)
+        canvas.text_rect(self.title, self.font, self.title_rect(), pg.Color('black'))
 
-    def draw_background(self):
-        pg.draw.rect(self.screen, pg.Color('white'),
-                     pg.Rect(self.left, self.top + self.title_height, self.width, self.height - self.title_height), 0)
+    def draw_background(self, canvas):
+        canvas.rect(pg.Color('white'), pg.Rect(0, self.title_height, self.width, self.height - self.title_height), 0)
 
     def draw_controls(self):
         for control in self.controls:
             control.render()
 
     def render(self):
-        if self.covered_screen is None:
-            self.covered_screen = self.screen.copy()
-        else:
-            self.screen.blit(self.covered_screen, (0, 0))
-        self.draw_title()
-        self.draw_x()
-        self.draw_background()
-        self.draw_controls()
-        pg.display.flip()
+        if self.screen.get_size() != (max(self.width, 1), max(self.height, 1)):
+            self.screen = self.display_list.surface = pg.Surface((max(self.width, 1), max(self.height, 1)), 0,
+                                                                 self.display)
+            self.display_list.damage(self.rect())
+        with self.display_list.record(self, root=True) as canvas:
+            self.draw_title(canvas)
+            self.draw_x()
+            self.draw_background(canvas)
+            self.draw_controls()
+        if self.show_profile:
+            self.draw_profile()
+        dirty_rects.update()
 
     def close(self):
-        if self.covered_screen is not None:
-            self.screen.blit(self.covered_screen, (0, 0))
-        pg.display.flip()
+        self.manager.close(self)
+        dirty_rects.update()
         self.visible = False
 
     def open(self):
+        self.manager.open(self)
         self.render()
         self.visible = True
 
-    def open_modal(self):
+    def open_modal(self, fps=60, idle_timeout=250):
         self.open()
+        clock = pg.time.Clock()
         while self.visible:
-            if pg.event.peek(pg.QUIT):
-                self.close()
-                break;
-            for event in pg.event.get():
+            events = pg.event.get()
+            if not events:
+                event = pg.event.wait(idle_timeout)
+                events = [event] + pg.event.get() if event.type != pg.NOEVENT else []
+            self.handle_events(events)
+            if fps:
+                clock.tick(fps)
+
+    async def run_async(self, fps=60):
+        self.open()
+        await pump_events(self.handle_events, lambda: self.visible, fps)
+
+    def handle_events(self, events):
+        dirty_rects.deferred = True
+        try:
+            for event in coalesce_events(events):
+                if tasks.handle_event(event):
+                    continue
+                if event.type == pg.QUIT:
+                    pg.event.post(event)
+                    self.close()
+                    break
                 self.handle_event(event)
+        finally:
+            dirty_rects.deferred = False
+        profiler.end_frame()
+        if self.show_profile and self.visible:
+            self.draw_profile()
+        else:
+            self.display_list.remove((self, 'profile'))
+        dirty_rects.update()
+
+    def draw_profile(self):
+        if not profiler.enabled:
+            return
+        font = get_font('Courier', 12)
+        lines = profiler.report(8)
+        line_size = font.get_linesize()
+        rect = pg.Rect(0, self.title_height, self.width,
+                       min(line_size * len(lines) + 4, self.height - self.title_height))
+        with self.display_list.record((self, 'profile'), root=True) as canvas:
+            canvas.transparent_rect((255, 255, 200, 220), rect)
+            canvas.set_clip(rect)
+            for i, line in enumerate(lines):
+                canvas.text(line, font, (rect.left + 2, rect.top + 2 + i * line_size), pg.Color('black'))
 
     def drag_to(self, pos):
         (x0, y0) = self.dragging_pos
@@ -662,11 +3141,10 @@ class PyForm(Control):
         self.left += x - x0
         self.top += y - y0
         self.dragging_pos = pos
-        self.render()
 
     def mouse_move(self, event):
         if self.dragging:
-            self.drag_to(event.pos)
+            self.drag_to(event.screen_pos)
             return
         (x, y) = event.pos
         if self.x_rect().collidepoint(x, y):
@@ -686,55 +3164,105 @@ class PyForm(Control):
     def mouse_down(self, event):
         if self.handle_rect().collidepoint(event.pos):
             self.dragging = True
-            self.dragging_pos = event.pos
+            self.dragging_pos = event.screen_pos
             return
 
     def handle_event(self, event):
+        if hasattr(event, 'pos'):
+            event = pg.event.Event(event.type, dict(event.dict, pos=(event.pos[0] - self.left, event.pos[1] - self.top),
+                                                    screen_pos=event.pos))
         super().handle_event(event)
-        pg.display.flip()
+        dirty_rects.update()
 
 class MenuItem(Control):
-    def __init__(self,text=""):
+    __slots__ = ('active', '_text', 'menu', 'padding_left', 'padding_right', 'on_mouse_click', 'submenu', 'dropdown')
+
+    def __init__(self,text="",on_mouse_click=None,submenu=None):
         super().__init__()
         self.active=False
-        self.text=text
         self.menu=None
+        self._text=text
         self.padding_left=5
         self.padding_right=5
-        self.on_mouse_click=None
+        self.on_mouse_click=on_mouse_click
+        # submenu is a list of item texts or a callable that fills the
+        # DropDown passed to it; either way it is only built when first opened
+        self.submenu=submenu
+        self.dropdown=None
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self,text):
+        self._text=text
+        if self.menu is not None:
+            self.menu.invalidate_layout()
+
+    def get_dropdown(self):
+        if self.dropdown is None and self.submenu is not None:
+            self.dropdown=DropDown(self.menu.root())
+            if callable(self.submenu):
+                self.submenu(self.dropdown)
+            else:
+                for text in self.submenu:
+                    self.dropdown.add_item(text)
+        return self.dropdown
+
+    def mouse_in(self, event):
+        super().mouse_in(event)
+        self.menu.item_changed(self)
+
+    def mouse_out(self, event):
+        super().mouse_out(event)
+        self.menu.item_changed(self)
 
     def mouse_click(self, event):
         if self.rect().collidepoint(event.pos):
-            for item in self.parent.controls:
-                item.active=False
-            self.active=True
-            if callable(self.on_mouse_click):
-                self.on_mouse_click(event)
+            self.menu.item_clicked(self,event)
+
+    def colors(self):
+        if self.active and self.parent.mouse_over:
+            return pg.Color('white'),pg.Color('blue')
+        elif self.mouse_over or self.active:
+            return pg.Color('black'),pg.Color('lightgray')
+        return pg.Color('black'),pg.Color('white')
 
     def render(self):
         if self.menu:
-            font=self.menu.font
-            self.left=0
-            for i in range(self.menu.controls.index(self)):
-                item=self.menu.controls[i]
-                self.left+=font.size(item.text)[0]+item.padding_left+item.padding_right
-            self.width=font.size(self.text)[0]+self.padding_left+self.padding_right
-            self.height=font.get_linesize()
-            if self.active and self.parent.mouse_over:
-                color = pg.Color('white')
-                background = pg.Color('blue')
-            elif self.mouse_over or self.active:
-                color = pg.Color('black')
-                background = pg.Color('lightgray')
-            else:
-                color=pg.Color('black')
-                background=pg.Color('white')
-            pg.draw.rect(self.menu.screen,background,self.rect())
-            render_text_rect(screen=self.menu.screen,text=self.text,font=self.parent.font,rect=self.rect(),color=color,background=background)
+            color,background=self.colors()
+            with self.canvas() as canvas:
+                canvas.rect(background,self.rect())
+                canvas.text_rect(self.text,self.menu.font,self.rect(),color,background)
+
+class MenuBase(Control):
+    # shared by Menu and DropDown: a list of MenuItems laid out by layout()
+    __slots__ = ('offsets', 'layout_font')
+
+    def __init__(self):
+        super().__init__()
+        self.offsets=None
+        self.layout_font=None
+
+    def add_item(self,text,on_mouse_click=None,submenu=None):
+        item=MenuItem(text,on_mouse_click,submenu)
+        item.menu=self
+        self.add_control(item)
+        self.invalidate_layout()
+        return item
+
+    def invalidate_layout(self):
+        self.offsets=None
+
+class Menu(MenuBase):
+    __slots__ = ('display_list', 'screen', 'active_item', 'dropdowns')
 
-class Menu(Control):
     def __init__(self,form=None,screen=None):
         super().__init__()
+        self.display_list=None
+        self.active_item=None
+        self.dropdowns=[]
         if form is not None:
             self.parent=form
             self.screen=form.screen
@@ -743,27 +3271,217 @@ class Menu(Control):
             self.parent=None
             self.screen=screen
             self.width=screen.get_width()
-
-    def add_item(self,text):
-        item=MenuItem(text)
-        item.menu=self
-        self.add_control(item)
+            # drawn by the compositor above the forms, so dropdowns can
+            # overlap them
+            manager=WindowManager.for_display(screen)
+            self.display_list=DisplayList(screen,manager.damage)
+            manager.add_overlay(self.display_list)
+
+    def get_display_list(self):
+        if self.display_list is not None:
+            return self.display_list
+        return super().get_display_list()
+
+    def root(self):
+        return self
+
+    def layout(self):
+        # prefix offsets of the items; recomputed only after items or the
+        # font changed
+        font=self.font
+        if self.offsets is None or self.layout_font is not font:
+            self.height=font.get_linesize()
+            self.offsets=[0]
+            for item in self.controls:
+                item.left=self.offsets[-1]
+                item.width=font.size(item.text)[0]+item.padding_left+item.padding_right
+                item.height=font.get_linesize()
+                self.offsets.append(item.left+item.width)
+            self.layout_font=font
+        return self.offsets
 
     def render(self):
-        self.height=self.font.get_linesize()
-        pg.draw.rect(self.screen,pg.Color('white'),self.rect())
-        for item in self.controls:
+        self.layout()
+        display_list=self.get_display_list()
+        if display_list is None:
+            return
+        with display_list.record(self,root=True) as canvas:
+            canvas.rect(pg.Color('white'),self.rect())
+            for item in self.controls:
+                item.render()
+
+    def item_clicked(self,item,event):
+        self.activate(item)
+        if item.submenu is not None:
+            self.toggle_submenu(item)
+        else:
+            self.close_dropdowns()
+            if callable(item.on_mouse_click):
+                call_handler(item.on_mouse_click,event)
+
+    def item_changed(self,item):
+        item.render()
+        if self.dropdowns and item.mouse_over and item.submenu is not None and self.dropdowns[0] is not item.dropdown:
+            self.activate(item)
+            self.open_submenu(item,0)
+
+    def activate(self,item):
+        previous,self.active_item=self.active_item,item
+        if previous is not None and previous is not item:
+            previous.active=False
+            previous.render()
+        if item is not None:
+            item.active=True
             item.render()
 
+    def toggle_submenu(self,item):
+        if self.dropdowns and self.dropdowns[0] is item.dropdown:
+            self.close_dropdowns()
+        else:
+            self.open_submenu(item,0)
+
+    def open_submenu(self,item,level):
+        dropdown=item.get_dropdown()
+        self.close_dropdowns(level)
+        if level==0:
+            dropdown.left,dropdown.top=item.rect().left,item.rect().bottom
+        else:
+            dropdown.left,dropdown.top=item.menu.rect().right,item.rect().top
+        dropdown.level=level
+        self.dropdowns.append(dropdown)
+        self.focused=True
+        dropdown.render()
+
+    def close_dropdowns(self,level=0):
+        display_list=self.get_display_list()
+        while len(self.dropdowns)>level:
+            dropdown=self.dropdowns.pop()
+            for item in dropdown.controls:
+                item.mouse_over=item.active=False
+            if display_list is not None:
+                display_list.remove(dropdown)
+        if not self.dropdowns:
+            self.focused=False
+
+    def mouse_down(self, event):
+        super().mouse_down(event)
+        if self.dropdowns:
+            self.focused=True
+
+    def mouse_in(self, event):
+        super().mouse_in(event)
+        if self.active_item is not None:
+            self.active_item.render()
+
+    def mouse_out(self, event):
+        super().mouse_out(event)
+        if self.active_item is not None:
+            self.active_item.render()
+
     def mouse_click(self, event):
-        for item in self.controls:
-            item.active=False
+        self.activate(None)
         super().mouse_click(event)
 
     def handle_event(self, event):
+        self.layout()
+        if self.dropdowns and hasattr(event,'pos'):
+            for dropdown in self.dropdowns[::-1]:
+                if dropdown in self.dropdowns and (dropdown.rect().collidepoint(event.pos) or dropdown.mouse_over):
+                    dropdown.handle_event(event)
+            if event.type==pg.MOUSEBUTTONDOWN and not self.rect().collidepoint(event.pos) and \
+                    not any(dropdown.rect().collidepoint(event.pos) for dropdown in self.dropdowns):
+                self.close_dropdowns()
         super().handle_event(event)
+        dirty_rects.update()
+
+class DropDown(MenuBase):
+    __slots__ = ('menu', 'level', 'surface', 'padding_left', 'padding_right')
+
+    def __init__(self,menu):
+        super().__init__()
+        self.menu=menu
+        self.level=0
+        self.surface=None
+        self.padding_left=5
+        self.padding_right=20
+
+    @property
+    def font(self):
+        return self.menu.font
+
+    def get_display_list(self):
+        return self.menu.get_display_list()
+
+    def root(self):
+        return self.menu
+
+    def invalidate_layout(self):
+        super().invalidate_layout()
+        self.surface=None
+
+    def layout(self):
+        font=self.font
+        if self.offsets is None or self.layout_font is not font:
+            line_size=font.get_linesize()
+            self.width=max([font.size(item.text)[0] for item in self.controls]+[0])+self.padding_left+self.padding_right
+            self.offsets=[0]
+            for item in self.controls:
+                item.left,item.top=0,self.offsets[-1]
+                item.width,item.height=self.width,line_size
+                self.offsets.append(item.top+line_size)
+            self.height=self.offsets[-1]
+            self.layout_font=font
+            self.surface=None
+        return self.offsets
+
+    def draw_item(self,canvas,item,rect,color,background):
+        canvas.rect(background,rect)
+        canvas.text(item.text,self.font,(rect.left+self.padding_left,rect.top),color)
+        if item.submenu is not None:
+            canvas.text('>',self.font,(rect.right-self.padding_right+6,rect.top),color)
+
+    def render_surface(self):
+        # the idle look of the whole dropdown is painted once; hovering only
+        # records the highlighted row on top of it
+        canvas=Canvas()
+        for item in self.controls:
+            self.draw_item(canvas,item,pg.Rect(item.left,item.top,item.width,item.height),pg.Color('black'),
+                           pg.Color('white'))
+        canvas.rect(pg.Color('black'),(0,0,self.width,self.height),1)
+        surface=pg.Surface((max(self.width,1),max(self.height,1)))
+        surface.fill(pg.Color('white'))
+        for op in canvas.items:
+            paint_item(surface,op)
+        return surface
+
+    def item_clicked(self,item,event):
+        if item.submenu is not None:
+            self.menu.open_submenu(item,self.level+1)
+        else:
+            self.menu.close_dropdowns()
+            if callable(item.on_mouse_click):
+                call_handler(item.on_mouse_click,event)
+
+    def item_changed(self,item):
+        if item.mouse_over:
+            if item.submenu is not None:
+                self.menu.open_submenu(item,self.level+1)
+            else:
+                self.menu.close_dropdowns(self.level+1)
         self.render()
-        pg.display.flip()
+
+    def render(self):
+        self.layout()
+        if self.surface is None:
+            self.surface=self.render_surface()
+        display_list=self.get_display_list()
+        if display_list is None or self not in self.menu.dropdowns:
+            return
+        with display_list.record(self,root=True) as canvas:
+            canvas.blit(self.surface,self.rect().topleft)
+            for item in self.controls:
+                if item.mouse_over:
+                    self.draw_item(canvas,item,item.rect(),pg.Color('white'),pg.Color('blue'))
 
 
 if __name__ == "__main__":
@@ -771,6 +3489,7 @@ if __name__ == "__main__":
     pg.font.init()
     screen = pg.display.set_mode((400, 400))
     pg.key.set_repeat(500, 100)
+    preload_fonts(('Courier', 18))
     form1 = PyForm(screen, 10, 30, 300, 200, title="Form1")
     form1.add_control(Button(form=form1, width=100, height=20, left=20, top=10, text="ABCgyl"))
     form1.add_control(Label(form=form1, width=100, height=20, top=50, left=20, text="ABCgyl"))
@@ -793,9 +3512,12 @@ if __name__ == "__main__":
 
     running = True
     while running:
-        for e in pg.event.get():
+        for e in coalesce_events([pg.event.wait()] + pg.event.get()):
+            if tasks.handle_event(e):
+                continue
             if e.type == pg.QUIT:
                 running = False
             elif form1.visible:
                 form1.handle_event(e)
             menu.handle_event(e)
+    tasks.shutdown(wait=False)
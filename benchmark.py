@@ -0,0 +1,378 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame as pg
+
+from PyForm import (Button, CheckBox, Control, DataGrid, Draggable, Label, ListBox, MappedBuffer, Menu, MenuItem,
+                    PyForm, RadioButton, TextBox, compile_form)
+
+benchmarks = []
+
+
+class Panel(Control):
+    def render(self):
+        for control in self.controls:
+            control.render()
+
+
+def benchmark(name, number=1, slow=False):
+    def register(setup):
+        benchmarks.append((name, setup, number, slow))
+        return setup
+    return register
+
+
+def event(type, **attributes):
+    return pg.event.Event(type, attributes)
+
+
+def motion(pos, rel=(0, 0), buttons=(0, 0, 0)):
+    return event(pg.MOUSEMOTION, pos=pos, rel=rel, buttons=buttons)
+
+
+def make_text(size, line_length=60):
+    rng = random.Random(size)
+    alphabet = "abcdefghijklmnopqrstuvwxyz      0123456789"
+    line = "".join(rng.choice(alphabet) for _ in range(line_length))
+    count = size // (line_length + 1) + 1
+    return "\n".join(line for _ in range(count))[:size]
+
+
+def make_form(screen, rows=20, cols=10):
+    form = PyForm(screen, 10, 10, 780, 580, title="Benchmark")
+    for row in range(rows):
+        for col in range(cols):
+            left, top = 10 + col * 75, 5 + row * 27
+            if (row + col) % 3 == 0:
+                form.add_control(Label(form=form, left=left, top=top, width=70, height=20, text="label"))
+            elif (row + col) % 3 == 1:
+                form.add_control(Button(form=form, left=left, top=top, width=70, height=20, text="button"))
+            else:
+                form.add_control(CheckBox(form=form, left=left, top=top))
+    return form
+
+
+def form_spec(rows=20, cols=10):
+    controls = []
+    for row in range(rows):
+        for col in range(cols):
+            left, top = 10 + col * 75, 5 + row * 27
+            if (row + col) % 3 == 0:
+                controls.append({"type": "Label", "left": left, "top": top, "width": 70, "height": 20, "text": "label"})
+            elif (row + col) % 3 == 1:
+                controls.append({"type": "Button", "left": left, "top": top, "width": 70, "height": 20,
+                                 "text": "button"})
+            else:
+                controls.append({"type": "CheckBox", "left": left, "top": top})
+    return {"title": "Benchmark", "left": 10, "top": 10, "width": 780, "height": 580, "controls": controls}
+
+
+@benchmark("form_build", number=20)
+def bench_form_build(screen):
+    return lambda: make_form(screen)
+
+
+@benchmark("form_load_lazy", number=20)
+def bench_form_load_lazy(screen):
+    layout = compile_form(form_spec())
+    return lambda: PyForm.load(screen, layout)
+
+
+@benchmark("form_render", number=20)
+def bench_form_render(screen):
+    form = make_form(screen)
+    form.open()
+    return form.render
+
+
+@benchmark("dispatch_motion", number=2000)
+def bench_dispatch_motion(screen):
+    form = PyForm(screen, 0, 0, 800, 600, title="Dispatch")
+    for i in range(10):
+        group = Panel(form=form, left=(i % 5) * 155, top=(i // 5) * 280, width=150, height=270)
+        form.add_control(group)
+        for j in range(100):
+            group.add_control(CheckBox(left=(j % 7) * 21, top=(j // 7) * 21))
+    form.open()
+    rng = random.Random(1)
+    events = [motion((rng.randrange(800), rng.randrange(600))) for _ in range(4096)]
+    state = {'i': 0}
+
+    def run():
+        state['i'] = (state['i'] + 1) % len(events)
+        Control.handle_event(form, events[state['i']])
+    return run
+
+
+def typing_benchmark(size):
+    def setup(screen):
+        form = PyForm(screen, 0, 0, 800, 600, title="Typing")
+        textbox = TextBox(form=form, left=10, top=10, width=760, height=540, text=make_text(size), multilines=True)
+        form.add_control(textbox)
+        form.open()
+        textbox.focused = True
+        textbox.set_caret_pos(size // 2)
+        keys = [event(pg.KEYDOWN, key=ord(c), unicode=c, mod=0) for c in "typing benchmark "]
+        state = {'i': 0}
+
+        def run():
+            state['i'] = (state['i'] + 1) % len(keys)
+            textbox.key_down(keys[state['i']])
+        return run
+    return setup
+
+
+benchmark("textbox_typing_10kb", number=200)(typing_benchmark(10 * 1024))
+benchmark("textbox_typing_1mb", number=200)(typing_benchmark(1024 * 1024))
+benchmark("textbox_typing_10mb", number=200, slow=True)(typing_benchmark(10 * 1024 * 1024))
+
+
+@benchmark("textbox_scrolled", number=200)
+def bench_textbox_scrolled(screen):
+    form = PyForm(screen, 0, 0, 800, 600, title="Scroll")
+    textbox = TextBox(form=form, left=10, top=10, width=400, height=300,
+                      text=make_text(1024 * 1024, line_length=120), multilines=True)
+    form.add_control(textbox)
+    form.open()
+    rng = random.Random(2)
+    positions = [rng.random() for _ in range(256)]
+    state = {'i': 0}
+
+    def run():
+        state['i'] = (state['i'] + 1) % len(positions)
+        scrollbar = textbox.vscrollbar if state['i'] % 2 else textbox.hscrollbar
+        textbox.scrolled(scrollbar, positions[state['i']])
+    return run
+
+
+@benchmark("textbox_grid_hover", number=500)
+def bench_textbox_grid_hover(screen):
+    form = PyForm(screen, 0, 0, 800, 600, title="Grid")
+    text = make_text(4 * 1024, line_length=60)
+    textboxes = [TextBox(form=form, left=10 + 130 * (i % 6), top=10 + 110 * (i // 6), width=120, height=100,
+                         text=text, multilines=True) for i in range(30)]
+    for textbox in textboxes:
+        form.add_control(textbox)
+    form.open()
+    events = [motion(textbox.rect().center) for textbox in textboxes]
+    state = {'i': 0}
+
+    def run():
+        state['i'] = (state['i'] + 1) % len(events)
+        form.handle_event(events[state['i']])
+    return run
+
+
+@benchmark("textbox_mapped_scrolled", number=200)
+def bench_textbox_mapped_scrolled(screen):
+    with tempfile.NamedTemporaryFile("w", suffix=".log", delete=False) as f:
+        f.write(make_text(16 * 1024 * 1024, line_length=120))
+    form = PyForm(screen, 0, 0, 800, 600, title="Mapped")
+    textbox = TextBox(form=form, left=10, top=10, width=400, height=300, multilines=True)
+    form.add_control(textbox)
+    form.open()
+    textbox.loaded(MappedBuffer(f.name))
+    os.unlink(f.name)
+    rng = random.Random(2)
+    positions = [rng.random() for _ in range(256)]
+    state = {'i': 0}
+
+    def run():
+        state['i'] = (state['i'] + 1) % len(positions)
+        scrollbar = textbox.vscrollbar if state['i'] % 2 else textbox.hscrollbar
+        textbox.scrolled(scrollbar, positions[state['i']])
+    return run
+
+
+def scroll_benchmark(make_list):
+    def setup(screen):
+        form = PyForm(screen, 0, 0, 800, 600, title="List")
+        control = make_list(form)
+        form.add_control(control)
+        form.open()
+        rng = random.Random(3)
+        rows = [rng.randrange(control.item_count()) for _ in range(256)]
+        state = {'i': 0}
+
+        def run():
+            state['i'] = (state['i'] + 1) % len(rows)
+            control.scroll_to(rows[state['i']])
+        return run
+    return setup
+
+
+benchmark("listbox_scroll_10m", number=200)(scroll_benchmark(
+    lambda form: ListBox(form=form, left=10, top=10, width=300, height=540,
+                         items=lambda i: "item %d" % i, count=10 ** 7)))
+benchmark("datagrid_scroll_10m", number=200)(scroll_benchmark(
+    lambda form: DataGrid(form=form, left=10, top=10, width=760, height=540,
+                          columns=[("id", 120), ("double", 160), ("name", 200), ("flag", 80)],
+                          items=lambda i: (i, i * 2, "name %d" % i, i % 2 == 0), count=10 ** 7)))
+
+
+@benchmark("draggable_drag", number=5)
+def bench_draggable_drag(screen):
+    form = make_form(screen, rows=10, cols=10)
+    draggable = Draggable(form=form, left=10, top=10, width=40, height=40)
+    form.add_control(draggable)
+    form.open()
+
+    def run():
+        start = draggable.rect().center
+        form.handle_event(motion(start))
+        form.handle_event(event(pg.MOUSEBUTTONDOWN, pos=start, button=1))
+        x, y = start
+        for step in range(200):
+            dx = 2 if step < 100 else -2
+            x, y = x + dx, y + 1 if step < 100 else y - 1
+            form.handle_event(motion((x, y), rel=(dx, 1), buttons=(1, 0, 0)))
+        form.handle_event(event(pg.MOUSEBUTTONUP, pos=(x, y), button=1))
+    return run
+
+
+@benchmark("menu_render", number=50)
+def bench_menu_render(screen):
+    menu = Menu(screen=screen)
+    for i in range(200):
+        menu.add_item("item%d" % i)
+    return menu.render
+
+
+@benchmark("menu_hover", number=500)
+def bench_menu_hover(screen):
+    menu = Menu(screen=screen)
+    for i in range(200):
+        menu.add_item("item%d" % i)
+    menu.render()
+    events = [motion((x, 5)) for x in range(0, screen.get_width(), 7)]
+    state = {'i': 0}
+
+    def run():
+        state['i'] = (state['i'] + 1) % len(events)
+        menu.handle_event(events[state['i']])
+    return run
+
+
+memory_controls = [
+    ("Label", lambda: Label(width=70, height=20, text="label")),
+    ("Button", lambda: Button(width=70, height=20, text="button")),
+    ("CheckBox", lambda: CheckBox()),
+    ("RadioButton", lambda: RadioButton()),
+    ("Draggable", lambda: Draggable(width=20, height=20)),
+    ("TextBox", lambda: TextBox(width=70, height=20, text="text")),
+    ("MenuItem", lambda: MenuItem("item")),
+]
+
+
+def measure_memory(screen, count=2000):
+    # bytes allocated per control, including its share of the parent's list
+    results = {}
+    for name, make in memory_controls:
+        form = PyForm(screen, 0, 0, 800, 600, title="Memory")
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(count):
+            form.add_control(make())
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        results[name] = used / count
+    return results
+
+
+def measure(run, number, repeat):
+    run()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run headless PyForm benchmarks and print JSON results.")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--quick", action="store_true", help="skip the slow benchmarks")
+    parser.add_argument("-c", "--compare", help="print the change against a previous JSON report")
+    args = parser.parse_args(argv)
+
+    pg.init()
+    screen = pg.display.set_mode((800, 600))
+    results = {}
+    for name, setup, number, slow in benchmarks:
+        if args.filter not in name or (slow and args.quick):
+            continue
+        start = time.perf_counter()
+        run = setup(screen)
+        setup_time = time.perf_counter() - start
+        times = measure(run, number, args.repeat)
+        results[name] = {
+            "number": number,
+            "repeat": args.repeat,
+            "setup": setup_time,
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.mean(times),
+        }
+        print("%-24s %12.3f us" % (name, min(times) * 1e6), file=sys.stderr)
+    memory = {}
+    if args.filter in "memory_per_control":
+        memory = measure_memory(screen)
+        for name, size in memory.items():
+            print("%-24s %12.0f bytes" % ("memory " + name, size), file=sys.stderr)
+    pg.quit()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "pygame": pg.version.ver,
+        "platform": platform.platform(),
+        "unit": "seconds per call",
+        "results": results,
+        "memory": memory,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for name, result in results.items():
+            if name in baseline["results"]:
+                previous = baseline["results"][name]["min"]
+                print("%-24s %+8.1f%%" % (name, (result["min"] / previous - 1) * 100), file=sys.stderr)
+        for name, size in memory.items():
+            if name in baseline.get("memory", {}):
+                previous = baseline["memory"][name]
+                print("%-24s %+8.1f%%" % ("memory " + name, (size / previous - 1) * 100), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()